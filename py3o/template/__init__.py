@@ -6,3 +6,9 @@ documents into real OpenOffice documents with all your data merged-in.
 from py3o.template.main import Template
 from py3o.template.main import TextTemplate
 from py3o.template.main import TemplateException
+from py3o.template.main import CompiledTemplate
+from py3o.template.cache import TemplateCache
+from py3o.template.cache import DiskTemplateCache
+from py3o.template.archive import CompressionPolicy
+from py3o.template.images import ImagePool
+from py3o.template.backends import RenderBackend
@@ -0,0 +1,535 @@
+# -*- encoding: utf-8 -*-
+"""Helpers to write the ODF zip archives.
+
+The zipfile module only knows how to write members from their uncompressed
+content. Most members of a rendered document are copied unchanged from the
+template, the functions here move their compressed data as is instead of
+inflating and deflating it again on each render. CompressionPolicy decides
+how the other members are compressed, and can deflate them on a pool of
+threads.
+"""
+import posixpath
+import shutil
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from copy import copy
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    # Python 2 without the futures backport, deflate in the calling thread
+    ThreadPoolExecutor = None
+
+# ZipFile.open() can write members since Python 3.6, the raw copy relies on
+# the ZipFile internals of the same versions
+ZIP_STREAMING = sys.version_info >= (3, 6)
+
+# general purpose flags of the zip members
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+
+# the deflate window, what a block can refer to in the previous one
+DEFLATE_WINDOW = 32768
+# the size of the chunks members are copied from files by
+COPY_CHUNK_SIZE = 64 * 1024
+
+# the smallest block deflated by a worker, each block costs the priming of
+# the compressor with the window of the previous one
+DEFLATE_BLOCK_SIZE = 256 * 1024
+
+# the date of the members a deterministic render adds to the document, the
+# earliest a zip archive can hold
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# what to do with the members copied unchanged from the template
+PASSTHROUGH_COPY = 'copy'
+PASSTHROUGH_RECOMPRESS = 'recompress'
+
+
+def read_raw_member(source, info):
+    """return the compressed data of a member of a zip archive
+
+    @param source: the archive, opened for reading
+    @type source: zipfile.ZipFile
+
+    @param info: the member to read
+    @type info: zipfile.ZipInfo
+    """
+    # the source archive may be shared by threads rendering the same
+    # template, zipfile serializes its own reads with this lock
+    with source._lock:
+        source.fp.seek(info.header_offset)
+        header = source.fp.read(zipfile.sizeFileHeader)
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile(
+                "Bad magic number for file header of %s" % info.filename
+            )
+        source.fp.seek(
+            fields[zipfile._FH_FILENAME_LENGTH] +
+            fields[zipfile._FH_EXTRA_FIELD_LENGTH],
+            1
+        )
+        data = source.fp.read(info.compress_size)
+
+    if len(data) != info.compress_size:
+        raise zipfile.BadZipfile("Truncated data for %s" % info.filename)
+    return data
+
+
+def can_copy_raw(info):
+    """tell if copy_member can move the compressed data of a member"""
+    return (
+        ZIP_STREAMING and
+        not info.flag_bits & FLAG_ENCRYPTED and
+        info.file_size < zipfile.ZIP64_LIMIT and
+        info.compress_size < zipfile.ZIP64_LIMIT
+    )
+
+
+def copy_member(source, out, info):
+    """copy a member of a zip archive into another one without
+    decompressing it. Its compression, CRC and dates are kept.
+
+    @param source: the archive to copy from, opened for reading
+    @type source: zipfile.ZipFile
+
+    @param out: the archive to copy to, opened for writing
+    @type out: zipfile.ZipFile
+
+    @param info: the member to copy
+    @type info: zipfile.ZipInfo
+    """
+    if not can_copy_raw(info):
+        # writestr updates the offsets of the ZipInfo it is given,
+        # hand it a copy to keep the source archive readable.
+        out.writestr(copy(info), source.read(info.filename))
+        return
+
+    write_raw_member(out, copy(info), read_raw_member(source, info))
+
+
+def write_file_member(out, zinfo, source, chunk_size=COPY_CHUNK_SIZE):
+    """write a member from a binary file object, by chunks
+
+    @param zinfo: the member, its file_size should be set to choose
+    between the zip and ZIP64 headers
+    @type zinfo: zipfile.ZipInfo
+
+    @param source: the content of the member
+    @type source: binary file object
+    """
+    if not ZIP_STREAMING:
+        out.writestr(zinfo, source.read())
+        return
+    with out.open(zinfo, 'w') as dest:
+        shutil.copyfileobj(source, dest, chunk_size)
+
+
+def begin_member(out, zinfo, sizes_known=True, zip64=False):
+    """write the local header of a member whose compressed data is then
+    written straight to out.fp, end_member must be called after it with the
+    same arguments
+
+    @param out: the archive, opened for writing
+    @type out: zipfile.ZipFile
+
+    @param zinfo: the member, its compression must be set
+    @type zinfo: zipfile.ZipInfo
+
+    @param sizes_known: False when the CRC and sizes of zinfo are only
+    known once the data is written
+    @type sizes_known: bool
+
+    @param zip64: write a ZIP64 header, for the members whose size may go
+    past the limits of the zip headers
+    @type zip64: bool
+    """
+    with out._lock:
+        if out._writing:
+            raise ValueError(
+                "Can't write to ZIP archive while an open writing handle "
+                "exists."
+            )
+        if out._seekable:
+            out.fp.seek(out.start_dir)
+        zinfo.flag_bits &= ~FLAG_DATA_DESCRIPTOR
+        if not sizes_known and not out._seekable:
+            # the header cannot be fixed, CRC and sizes follow the data
+            zinfo.flag_bits |= FLAG_DATA_DESCRIPTOR
+        zinfo.header_offset = out.fp.tell()
+        out._writecheck(zinfo)
+        out._didModify = True
+
+        out.fp.write(zinfo.FileHeader(zip64))
+        out._writing = True
+
+
+def end_member(out, zinfo, sizes_known=True, zip64=False):
+    """finish a member started with begin_member, once its CRC and sizes
+    are set in zinfo
+    """
+    try:
+        if not zip64 and (
+            zinfo.file_size > zipfile.ZIP64_LIMIT or
+            zinfo.compress_size > zipfile.ZIP64_LIMIT
+        ):
+            raise zipfile.LargeZipFile(
+                "%s would require ZIP64 extensions" % zinfo.filename
+            )
+        if zinfo.flag_bits & FLAG_DATA_DESCRIPTOR:
+            # the sizes of a ZIP64 data descriptor take 8 bytes
+            out.fp.write(struct.pack(
+                '<LLQQ' if zip64 else '<LLLL', DATA_DESCRIPTOR_SIGNATURE,
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size
+            ))
+            out.start_dir = out.fp.tell()
+        elif not sizes_known:
+            # write the header again now that it can be complete
+            out.start_dir = out.fp.tell()
+            out.fp.seek(zinfo.header_offset)
+            out.fp.write(zinfo.FileHeader(zip64))
+            out.fp.seek(out.start_dir)
+        else:
+            out.start_dir = out.fp.tell()
+
+        out.filelist.append(zinfo)
+        out.NameToInfo[zinfo.filename] = zinfo
+    finally:
+        out._writing = False
+
+
+def write_raw_member(out, zinfo, data):
+    """write a member of which the compressed data, CRC and sizes are known
+
+    @param data: the data of the member, compressed with the compression
+    set in zinfo
+    @type data: bytes
+    """
+    begin_member(out, zinfo)
+    try:
+        out.fp.write(data)
+    except Exception:
+        out._writing = False
+        raise
+    end_member(out, zinfo)
+
+
+def deflate(data, level, zdict=None, finish=True):
+    """return data compressed as a raw deflate stream
+
+    @param level: the zlib compression level
+    @type level: int
+
+    @param zdict: the data preceding this block in the member, the
+    compressor may refer to it
+    @type zdict: bytes
+
+    @param finish: False to end the block on a byte boundary without
+    ending the stream, the deflated blocks that follow are appended to it
+    @type finish: bool
+    """
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH
+    )
+
+
+def deflate_member(data, level):
+    """return the (CRC, size, deflated data) of the data of a member"""
+    return zlib.crc32(data) & 0xffffffff, len(data), deflate(data, level)
+
+
+def write_deflated_member(out, zinfo, deflated):
+    """write a member compressed by deflate_member
+
+    @param deflated: the result of deflate_member
+    @type deflated: a (CRC, size, data) tuple
+    """
+    zinfo.CRC, zinfo.file_size, data = deflated
+    zinfo.compress_size = len(data)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    write_raw_member(out, zinfo, data)
+
+
+def iter_grouped(blocks, size):
+    """join consecutive blocks of data until they reach size bytes"""
+    grouped = []
+    grouped_size = 0
+    for block in blocks:
+        grouped.append(block)
+        grouped_size += len(block)
+        if grouped_size >= size:
+            yield b''.join(grouped)
+            grouped = []
+            grouped_size = 0
+    if grouped:
+        yield b''.join(grouped)
+
+
+def write_deflated_blocks(out, zinfo, blocks, executor, level, queued=None,
+                          block_size=DEFLATE_BLOCK_SIZE):
+    """write a member from blocks of its data, deflating the blocks on
+    executor while the next ones are produced
+
+    Each block is deflated with the end of the previous one as dictionary
+    and ended on a byte boundary, their concatenation is a single deflate
+    stream. The CRC is computed in order by the calling thread.
+
+    @param blocks: the uncompressed data of the member, small blocks are
+    joined up to block_size bytes
+    @type blocks: iterable of bytes
+
+    @param executor: where to deflate the blocks
+    @type executor: concurrent.futures.Executor
+
+    @param level: the zlib compression level
+    @type level: int
+
+    @param queued: the number of blocks deflated ahead of the writing,
+    twice the number of workers of executor when None
+
+    @param block_size: the size of the blocks deflated by the workers
+    @type block_size: int
+
+    @returns: a generator of the uncompressed size of each block written
+    """
+    if queued is None:
+        queued = 2 * getattr(executor, '_max_workers', 1)
+
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+    # the size of the member is unknown until it is written, it may need
+    # the ZIP64 extensions when the archive allows them
+    zip64 = out._allowZip64
+    begin_member(out, zinfo, sizes_known=False, zip64=zip64)
+
+    try:
+        pending = deque()
+        previous = None
+        crc = 0
+        for block in iter_grouped(blocks, block_size):
+            crc = zlib.crc32(block, crc)
+            zinfo.file_size += len(block)
+            pending.append((len(block), executor.submit(
+                deflate, block, level,
+                previous[-DEFLATE_WINDOW:] if previous else None, False
+            )))
+            previous = block
+
+            while pending and (
+                len(pending) > queued or pending[0][1].done()
+            ):
+                size, future = pending.popleft()
+                data = future.result()
+                out.fp.write(data)
+                zinfo.compress_size += len(data)
+                yield size
+
+        while pending:
+            size, future = pending.popleft()
+            data = future.result()
+            out.fp.write(data)
+            zinfo.compress_size += len(data)
+            yield size
+
+        # an empty final block ends the stream
+        data = deflate(b'', level)
+        out.fp.write(data)
+        zinfo.compress_size += len(data)
+        zinfo.CRC = crc & 0xffffffff
+    except BaseException:
+        out._writing = False
+        raise
+
+    end_member(out, zinfo, sizes_known=False, zip64=zip64)
+
+
+class CompressionPolicy(object):
+    """decide how each member of a rendered document is compressed
+
+    XML documents and other text members are deflated. The mimetype member
+    is stored, as the ODF specification requires, and so are the members
+    whose format is already compressed: deflating them again costs time and
+    saves nothing.
+    """
+
+    # extensions of the members that are stored without compression
+    stored_extensions = frozenset([
+        'png', 'jpg', 'jpeg', 'gif', 'webp', 'jp2', 'svgz', 'wmz', 'emz',
+        'woff', 'woff2', 'zip', 'jar', 'gz', 'bz2', 'xz', '7z',
+        'mp3', 'mp4', 'm4a', 'ogg', 'oga', 'ogv', 'webm', 'avi', 'mov',
+    ])
+
+    # image types that compress well, other images are stored
+    compressible_images = frozenset([
+        'svg', 'svg+xml', 'bmp', 'x-ms-bmp', 'wmf', 'x-wmf', 'emf', 'x-emf',
+        'tif', 'tiff',
+    ])
+
+    def __init__(self, deflate_level=6, passthrough=PASSTHROUGH_COPY,
+                 workers=None):
+        """
+        @param deflate_level: the zlib compression level of the deflated
+        members, from 1 (fastest) to 9 (smallest)
+        @type deflate_level: int. Default is 6
+
+        @param passthrough: PASSTHROUGH_COPY to copy the members that are
+        not rendered with the compression they have in the template,
+        PASSTHROUGH_RECOMPRESS to apply this policy to them too
+        @type passthrough: string. Default is PASSTHROUGH_COPY
+
+        @param workers: the number of threads deflating the members, zlib
+        releases the GIL while it works. The rendered documents are
+        deflated by blocks while they are generated, the other members
+        while the documents are rendered. The threads are shared by the
+        renders using this policy.
+        @type workers: int. Default is None, the members are deflated by
+        the rendering thread
+        """
+        if passthrough not in (PASSTHROUGH_COPY, PASSTHROUGH_RECOMPRESS):
+            raise ValueError("unknown passthrough mode: %r" % passthrough)
+        self.deflate_level = deflate_level
+        self.passthrough = passthrough
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get_executor(self):
+        """return the pool of threads deflating the members, or None when
+        they are deflated by the rendering thread
+        """
+        if not self.workers or ThreadPoolExecutor is None or (
+            not ZIP_STREAMING
+        ):
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers)
+            return self._executor
+
+    def is_stored(self, filename):
+        """tell if a member is stored without compression"""
+        if filename == 'mimetype' or filename.endswith('/'):
+            return True
+        extension = posixpath.splitext(filename)[1][1:].lower()
+        return extension in self.stored_extensions
+
+    def get_info(self, filename, source_info=None, stored=None,
+                 date_time=None):
+        """return the ZipInfo to write a member with
+
+        @param filename: the name of the member in the output archive
+        @type filename: string
+
+        @param source_info: the member of the template this one replaces,
+        its date and attributes are kept
+        @type source_info: zipfile.ZipInfo
+
+        @param stored: force the member to be stored or deflated instead of
+        deciding from its name
+        @type stored: bool
+
+        @param date_time: the date of a member the template does not have,
+        see FIXED_DATE_TIME
+        @type date_time: a (year, month, day, hour, minute, second) tuple.
+        Default is the current time
+        """
+        if source_info is not None:
+            zinfo = copy(source_info)
+            zinfo.filename = filename
+        else:
+            if date_time is None:
+                date_time = time.localtime(time.time())[:6]
+            zinfo = zipfile.ZipInfo(filename, date_time=date_time)
+            zinfo.external_attr = 0o600 << 16
+
+        if stored is None:
+            stored = self.is_stored(filename)
+
+        if stored:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            # the level of each member can be set since Python 3.7
+            if hasattr(zinfo, '_compresslevel'):
+                zinfo._compresslevel = self.deflate_level
+        return zinfo
+
+    def get_image_info(self, identifier, mime_type=None, date_time=None):
+        """return the ZipInfo to write an image added to the document
+
+        @param identifier: the name of the image in the output archive
+        @type identifier: string
+
+        @param mime_type: the type of the image, either a mime type like
+        'image/png' or a short one like 'png'
+        @type mime_type: string
+
+        @param date_time: the date of the member, see get_info
+        """
+        if mime_type:
+            image_type = mime_type.rsplit('/', 1)[-1].lower()
+        else:
+            image_type = posixpath.splitext(identifier)[1][1:].lower()
+        return self.get_info(
+            identifier, stored=image_type not in self.compressible_images,
+            date_time=date_time,
+        )
+
+    def get_copy_info(self, info):
+        """return the ZipInfo to write a member the rendering leaves
+        unchanged with, None when its compressed data is copied as is
+        """
+        if self.passthrough == PASSTHROUGH_COPY:
+            return None
+        return self.get_info(info.filename, info)
+
+    def deflate_later(self, executor, data):
+        """deflate the data of a member on executor
+
+        @param data: the data, or a function returning it
+        @type data: bytes or callable
+
+        @returns: a future of the argument of write_deflated_member
+        """
+        def work():
+            return deflate_member(
+                data() if callable(data) else data, self.deflate_level
+            )
+        return executor.submit(work)
+
+    def copy_member(self, source, out, info, deflated=None):
+        """copy a member the rendering leaves unchanged
+
+        @param source: the template archive, opened for reading
+        @type source: zipfile.ZipFile
+
+        @param out: the output archive, opened for writing
+        @type out: zipfile.ZipFile
+
+        @param info: the member to copy
+        @type info: zipfile.ZipInfo
+
+        @param deflated: the future returned by deflate_later for this
+        member
+        """
+        zinfo = self.get_copy_info(info)
+        if zinfo is None:
+            copy_member(source, out, info)
+        elif deflated is not None:
+            write_deflated_member(out, zinfo, deflated.result())
+        else:
+            out.writestr(zinfo, source.read(info.filename))
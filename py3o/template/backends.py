@@ -0,0 +1,204 @@
+# -*- encoding: utf-8 -*-
+"""The engines rendering the prepared documents of the templates.
+
+Once prepared, each templated file of a py3o template is a Genshi markup
+template. A render backend compiles the markup events of these documents,
+renders a compiled document with the data of a render, and serializes the
+result into the text of the XML document written in the output archive.
+
+Genshi is the default backend. Give another RenderBackend instance as the
+engine of a Template to render its documents differently, for instance to
+instrument or cache the renders, or to benchmark engines on the same
+templates.
+"""
+from genshi.core import QName, Stream, START
+from genshi.template import MarkupTemplate
+
+from py3o.template.fast import XML_ID, FastTemplate, UnsupportedTemplate
+from py3o.template.segments import iter_static_segments
+
+
+class ListIdFilter(object):
+    """A stream filter giving a new xml:id to every list element.
+
+    Because if we duplicate lists we create invalid XML: each list must
+    have its own xml:id. This is important if you want to be able to reopen
+    the produced document with an XML parser. LibreOffice will fix those
+    ids itself silently, but lxml.etree.parse will bork on such duplicated
+    lists.
+
+    The lists are numbered in the order of the document, by a counter of
+    each render: the ids are unique in the document, and the same from one
+    render to the next.
+    """
+
+    def __init__(self, list_tag):
+        """
+        @param list_tag: the name of the list elements
+        @type list_tag: genshi.core.QName
+        """
+        self.list_tag = list_tag
+
+    def __call__(self, stream):
+        list_tag = self.list_tag
+        count = 0
+        for kind, data, pos in stream:
+            if kind is START and data[0] == list_tag:
+                count += 1
+                tag, attrs = data
+                data = tag, attrs | [(XML_ID, 'list%d' % count)]
+            yield kind, data, pos
+
+
+def get_list_tag(namespaces):
+    """return the name of the list elements, None when the document does
+    not declare the text namespace
+    """
+    if not namespaces.get('text'):
+        return None
+    return QName('{%s}list' % namespaces['text'])
+
+
+class RenderBackend(object):
+    """The interface of the render backends.
+
+    One backend instance is used by any number of templates and renders at
+    the same time: what is specific to a document belongs to the compiled
+    document, and what is specific to a render to its output.
+    """
+
+    #: the name of the engine, as given to Template
+    name = None
+
+    def compile(self, events, namespaces, lookup='strict',
+                flush_size=65536, filename=None):
+        """compile a prepared document
+
+        @param events: the Genshi markup events of the prepared document.
+        Every py:for iterates through the __py3o_loop function of the data.
+        @type events: iterable
+
+        @param namespaces: the namespace uris of the document by prefix
+        @type namespaces: dict
+
+        @param lookup: the Genshi variable lookup, 'strict' or 'lenient'
+        when the undefined variables are ignored
+        @type lookup: string
+
+        @param flush_size: the number of characters the serialized output
+        should be yielded by
+        @type flush_size: int
+
+        @param filename: the name of the document in the template
+        @type filename: string
+
+        @returns: the compiled document, given to generate
+
+        @raises: UnsupportedTemplate when the backend cannot render this
+        document, which is then rendered by Genshi
+        """
+        raise NotImplementedError
+
+    def generate(self, document, data):
+        """render a compiled document
+
+        @param document: the result of compile
+        @param data: the data of the template, the user data and the py3o
+        functions
+        @type data: dict
+
+        @returns: the output of the render, given to serialize. Nothing
+        should be rendered until serialize is iterated on.
+        """
+        raise NotImplementedError
+
+    def serialize(self, output):
+        """serialize the output of a render
+
+        @param output: the result of generate
+
+        @returns: an iterable of the blocks of the XML document, as text
+        """
+        raise NotImplementedError
+
+
+class GenshiBackend(RenderBackend):
+    """renders the documents with Genshi MarkupTemplates"""
+
+    name = 'genshi'
+
+    def compile(self, events, namespaces, lookup='strict',
+                flush_size=65536, filename=None):
+        list_tag = get_list_tag(namespaces)
+        lists = []
+
+        def find_lists(events):
+            for event in events:
+                if event[0] is START and event[1][0] == list_tag:
+                    lists.append(event)
+                yield event
+
+        # the static parts of the document are serialized only once
+        events = iter_static_segments(find_lists(events), list_tag)
+        template = MarkupTemplate(Stream(events), lookup=lookup)
+        # the documents without lists are not filtered at all
+        return template, lists and ListIdFilter(list_tag) or None
+
+    def generate(self, document, data):
+        template, list_filter = document
+        stream = template.generate(**data)
+        if list_filter is not None:
+            stream = stream | list_filter
+        return stream
+
+    def serialize(self, output):
+        return output.serialize()
+
+
+class FastBackend(RenderBackend):
+    """renders the documents compiled into Python code, see
+    py3o.template.fast"""
+
+    name = 'fast'
+
+    def compile(self, events, namespaces, lookup='strict',
+                flush_size=65536, filename=None):
+        return FastTemplate(
+            events, lookup=lookup, list_tag=get_list_tag(namespaces),
+            flush_size=flush_size, filename=filename,
+        )
+
+    def generate(self, document, data):
+        return document.generate(**data)
+
+    def serialize(self, output):
+        # the fast engine renders serialized text
+        return output
+
+
+BACKENDS = dict(
+    (backend.name, backend) for backend in (GenshiBackend, FastBackend)
+)
+
+DEFAULT_BACKEND = GenshiBackend()
+
+
+def get_backend(engine):
+    """return the backend of an engine
+
+    @param engine: the name of a backend or a RenderBackend instance
+    @type engine: string or RenderBackend
+
+    @raises: ValueError for an unknown engine
+    """
+    if isinstance(engine, RenderBackend):
+        return engine
+    if engine not in BACKENDS:
+        raise ValueError(
+            "Unknown engine %r, use one of %s or a RenderBackend" % (
+                engine, ', '.join(sorted(BACKENDS))
+            )
+        )
+    if engine == DEFAULT_BACKEND.name:
+        return DEFAULT_BACKEND
+    return BACKENDS[engine]()
@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+"""Caches of prepared py3o templates.
+
+Preparing a template means opening the ODF archive, parsing its XML
+documents and transforming the py3o instructions into Genshi templates.
+This is done once per template by :class:`CompiledTemplate`; the classes in
+this module make sure it is done once per process, or even once for all
+processes sharing a cache directory.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+import genshi
+
+from py3o.template.main import CompiledTemplate, get_template_file, is_path
+
+# bump this each time the prepared form of the templates changes
+CACHE_FORMAT = 1
+CACHE_META = 'py3o-cache.json'
+
+
+def get_py3o_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('py3o.template').version
+    except Exception:  # pragma: no cover
+        return 'unknown'
+
+
+def get_fingerprint(template, use_stat=False):
+    """identify a template
+
+    @param template: the path of a py3o template file as a string or a
+    path object, a binary file object containing it or its content as bytes
+
+    @param use_stat: identify templates given by path with their
+    modification time and size instead of hashing their content
+
+    @returns: a (fingerprint, source) tuple where source can be given to
+    CompiledTemplate in place of template
+    """
+    if use_stat and is_path(template):
+        stat = os.stat(template)
+        fingerprint = "%s:%s:%s" % (
+            os.path.abspath(template), stat.st_mtime, stat.st_size
+        )
+        return fingerprint, template
+
+    if is_path(template):
+        with open(template, 'rb') as f:
+            data = f.read()
+    else:
+        data = get_template_file(template).read()
+    return hashlib.sha256(data).hexdigest(), BytesIO(data)
+
+
+class TemplateCache(object):
+    """A thread safe LRU cache of :class:`CompiledTemplate` objects.
+
+    Templates are identified by the SHA-256 of the archive bytes, or by
+    their path, modification time and size when `use_stat` is set. The
+    rendering options are part of the key because they change the way the
+    template is prepared, and so are the render options given to the
+    CompiledTemplate.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=None, use_stat=False,
+                 disk_cache=None):
+        """
+        @param max_entries: the maximum number of templates kept in memory
+        @type max_entries: int
+
+        @param max_bytes: the maximum estimated size of all the templates
+        kept in memory, see CompiledTemplate.size. No limit if None.
+        @type max_bytes: int or None
+
+        @param use_stat: identify templates given by path with their
+        modification time and size instead of hashing their content
+        @type use_stat: boolean. Default is False
+
+        @param disk_cache: a second level cache used on misses
+        @type disk_cache: DiskTemplateCache or None
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.use_stat = use_stat
+        self.disk_cache = disk_cache
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, template, ignore_undefined_variables=False,
+            escape_false=False, compression=None, engine='genshi',
+            image_pool=None, deterministic=False):
+        """return the CompiledTemplate for the given template, preparing it
+        if it is not in the cache yet
+
+        @param template: the path of a py3o template file, a binary file
+        object containing it or its content as bytes
+
+        The other arguments are given to the CompiledTemplate, see its
+        documentation.
+        """
+        options = (bool(ignore_undefined_variables), bool(escape_false))
+        render_options = {
+            'compression': compression,
+            'engine': engine,
+            'image_pool': image_pool,
+            'deterministic': bool(deterministic),
+        }
+        fingerprint, source = get_fingerprint(template, self.use_stat)
+
+        key = (fingerprint, options) + tuple(sorted(render_options.items()))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # move it to the most recently used end
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # prepare outside the lock, the worst case is two threads preparing
+        # the same template and the last one winning the cache slot
+        if self.disk_cache is not None:
+            compiled = self.disk_cache.load_or_compile(
+                source, fingerprint, options, **render_options
+            )
+        else:
+            compiled = CompiledTemplate(
+                source,
+                ignore_undefined_variables=ignore_undefined_variables,
+                escape_false=escape_false,
+                **render_options
+            )
+        self._store(key, compiled)
+        return compiled
+
+    def clear(self):
+        """drop every cached template, counters are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """return the cache counters as a dictionary"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _store(self, key, compiled):
+        size = compiled.size
+        if self.max_bytes is not None and size > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+
+            self._entries[key] = compiled
+            self.total_bytes += size
+
+            while self._entries and (
+                len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and
+                    self.total_bytes > self.max_bytes
+                )
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.evictions += 1
+
+
+class DiskTemplateCache(object):
+    """A directory of prepared templates.
+
+    The prepared XML documents of each template are stored in one file
+    along with the template fingerprint and the py3o.template and Genshi
+    versions. A new process can then build its CompiledTemplate objects
+    without transforming the py3o instructions again. Entries written by
+    other versions are ignored and replaced.
+    """
+
+    def __init__(self, directory, use_stat=False):
+        """
+        @param directory: where to store the prepared templates, it is
+        created if needed
+        @type directory: string
+
+        @param use_stat: identify templates given by path with their
+        modification time and size instead of hashing their content
+        @type use_stat: boolean. Default is False
+        """
+        self.directory = directory
+        self.use_stat = use_stat
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, template, ignore_undefined_variables=False,
+            escape_false=False, compression=None, engine='genshi',
+            image_pool=None, deterministic=False):
+        """return the CompiledTemplate for the given template, using the
+        stored prepared documents when they are available
+
+        @param template: the path of a py3o template file, a binary file
+        object containing it or its content as bytes
+
+        The other arguments are given to the CompiledTemplate, see its
+        documentation.
+        """
+        options = (bool(ignore_undefined_variables), bool(escape_false))
+        fingerprint, source = get_fingerprint(template, self.use_stat)
+        return self.load_or_compile(
+            source, fingerprint, options, compression=compression,
+            engine=engine, image_pool=image_pool, deterministic=deterministic,
+        )
+
+    def load_or_compile(self, source, fingerprint, options, **kwargs):
+        """return the CompiledTemplate of source, either from its stored
+        prepared form or by preparing it and storing the result
+
+        @param kwargs: the options of the CompiledTemplate which do not
+        change the stored prepared documents, like the compression or the
+        engine
+        """
+        ignore_undefined_variables, escape_false = options
+        path = self.get_path(fingerprint, options)
+
+        prepared = self.load(path, fingerprint, options)
+        if prepared is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        compiled = CompiledTemplate(
+            source,
+            ignore_undefined_variables=ignore_undefined_variables,
+            escape_false=escape_false,
+            prepared=prepared,
+            **kwargs
+        )
+        if prepared is None:
+            self.store(path, fingerprint, options, compiled)
+        return compiled
+
+    def get_path(self, fingerprint, options):
+        key = "%s:%d:%d" % ((fingerprint,) + tuple(options))
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(key.encode('utf-8')).hexdigest() + '.py3oc'
+        )
+
+    @staticmethod
+    def get_meta(fingerprint, options):
+        return {
+            'format': CACHE_FORMAT,
+            'py3o': get_py3o_version(),
+            'genshi': genshi.__version__,
+            'fingerprint': fingerprint,
+            'options': list(options),
+        }
+
+    def load(self, path, fingerprint, options):
+        """return the prepared form stored in path or None if it is missing
+        or was not written for this template and these versions
+        """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with zipfile.ZipFile(path, 'r') as archive:
+                meta = json.loads(archive.read(CACHE_META).decode('utf-8'))
+                expected = self.get_meta(fingerprint, options)
+                if any(meta.get(k) != v for k, v in expected.items()):
+                    return None
+
+                documents = [
+                    archive.read(name) for name in meta['documents']
+                ]
+                return documents, meta['static_images']
+
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            # a corrupted entry is just a cache miss
+            return None
+
+    def store(self, path, fingerprint, options, compiled):
+        """write the prepared form of compiled to path"""
+        documents, static_images = compiled.dump_prepared()
+        meta = self.get_meta(fingerprint, options)
+        meta['documents'] = compiled.template.templated_files
+        meta['static_images'] = static_images
+
+        # write in a temporary file then move it in place so that other
+        # processes never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    archive.writestr(CACHE_META, json.dumps(meta))
+                    for name, document in zip(meta['documents'], documents):
+                        archive.writestr(name, document)
+            getattr(os, 'replace', os.rename)(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+# the process wide cache
+default_cache = TemplateCache()
@@ -0,0 +1,764 @@
+# -*- encoding: utf-8 -*-
+"""A code generating engine to render the prepared py3o documents.
+
+Genshi interprets the directives of a template at each render and produces
+one event per XML node, which then goes through several stream filters
+before being serialized. The prepared py3o documents only use a few
+directives (py:for, py:if, py:content, py:replace, py:attrs and py:strip),
+so they can instead be compiled once into a Python generator which writes
+the static parts of the document as pre-serialized strings and evaluates
+the expressions inline, with the lookup rules of Genshi.
+
+The output is the same as the one of Genshi serializing the template with
+the list id filter of py3o. Documents using anything else raise
+:class:`UnsupportedTemplate` when compiled, and are rendered by Genshi.
+"""
+import ast
+import re
+from itertools import chain
+
+import six
+
+from genshi.core import Attrs, Markup, QName, Stream, escape
+from genshi.core import START, END, TEXT, START_NS, END_NS, XML_NAMESPACE
+from genshi.template import MarkupTemplate
+from genshi.template.astutil import ASTCodeGenerator, parse
+from genshi.template.base import EXPR, Context
+from genshi.template.eval import (
+    ExpressionASTTransformer, LenientLookup, StrictLookup, UndefinedError,
+)
+from genshi.template.interpolation import interpolate
+
+DIRECTIVE_NAMESPACE = MarkupTemplate.DIRECTIVE_NAMESPACE
+
+# the directives this engine implements, in the order Genshi applies them
+DIRECTIVES = ['for', 'if', 'replace', 'content', 'attrs', 'strip']
+
+# the argument of the directives used as elements
+ELEMENT_DIRECTIVES = {'for': 'each', 'if': 'test'}
+
+XML_ID = QName(XML_NAMESPACE.uri + '}id')
+XML_SPACE = QName(XML_NAMESPACE.uri + '}space')
+
+NUMERIC_TYPES = (float, ) + six.integer_types
+
+# see genshi.output.WhitespaceFilter
+trim_trailing_space = re.compile('[ \t]+(?=\n)').sub
+collapse_lines = re.compile('\n{2,}').sub
+
+
+class UnsupportedTemplate(ValueError):
+    """the document uses a Genshi feature the fast engine does not
+    implement"""
+
+
+def normalize_space(text):
+    """strip the whitespace like the XML serializer of Genshi does"""
+    if '\n' not in text:
+        return text
+    return collapse_lines('\n', trim_trailing_space('', text))
+
+
+def get_expression_code(source):
+    """return the Python code of a template expression, with the name,
+    attribute and item lookups of Genshi
+    """
+    try:
+        tree = parse(source.strip(), 'eval')
+    except SyntaxError:
+        # Genshi reports the error with the position in the template
+        raise UnsupportedTemplate("invalid expression %r" % source)
+    tree = ExpressionASTTransformer().visit(tree)
+    return ASTCodeGenerator(tree).code.strip()
+
+
+def get_assignment(target):
+    """return the names assigned by the target of a py:for directive, as a
+    name or a tuple of names like genshi.template.directives._assignment
+    """
+    def names(node):
+        if isinstance(node, ast.Tuple):
+            return tuple(names(child) for child in node.elts)
+        if isinstance(node, ast.Name):
+            return node.id
+        raise UnsupportedTemplate("cannot assign to %r" % target)
+
+    try:
+        statement = ast.parse(target.strip(), mode='exec').body[0]
+    except (SyntaxError, IndexError):
+        raise UnsupportedTemplate("invalid loop target %r" % target)
+    if not isinstance(statement, ast.Expr):
+        raise UnsupportedTemplate("invalid loop target %r" % target)
+    return names(statement.value)
+
+
+def iter_value_texts(value, markup_events=False):
+    """return the texts Genshi outputs for the value of an expression
+
+    @param markup_events: the value may be a stream of markup events, only
+    their text is kept. When False, such a stream is an error.
+    """
+    if value is None:
+        return
+    if isinstance(value, six.string_types):
+        yield value
+    elif isinstance(value, NUMERIC_TYPES):
+        yield Markup(value)
+    elif hasattr(value, '__iter__'):
+        items = iter(value)
+        for first in items:
+            if type(first) is tuple and len(first) == 3:
+                # a markup stream, see genshi.core._ensure
+                for kind, data, pos in chain([first], items):
+                    if kind is TEXT:
+                        if data is not None:
+                            yield data
+                    elif not markup_events:
+                        raise UnsupportedTemplate(
+                            "the fast engine cannot insert markup events, "
+                            "render this template with Genshi"
+                        )
+            else:
+                for item in chain([first], items):
+                    if hasattr(item, 'totuple'):
+                        raise UnsupportedTemplate(
+                            "the fast engine cannot insert markup events, "
+                            "render this template with Genshi"
+                        )
+                    yield six.text_type(item)
+            break
+    else:
+        yield six.text_type(value)
+
+
+class Writer(object):
+    """The serializer state of a render.
+
+    A start tag waits until the next event to know whether its element is
+    empty, and text waits for the end of its run to be escaped and have its
+    whitespace stripped, see the EmptyTagFilter and WhitespaceFilter of
+    Genshi. The generated code calls these methods with the pre-serialized
+    static parts of the document.
+    """
+
+    def __init__(self):
+        self.out = []
+        self.size = 0
+        self.pending = None
+        self.texts = []
+        # the namespaces prefixes generated for unknown attribute namespaces
+        self.generated = {}
+        self.lists = 0
+
+    def flush_texts(self):
+        texts = self.texts
+        if len(texts) > 1:
+            text = Markup('').join(texts, escape_quotes=False)
+        else:
+            text = escape(texts[0], quotes=False)
+        self.texts = []
+        text = normalize_space(text)
+        self.out.append(text)
+        self.size += len(text)
+
+    def start(self, markup, pending):
+        """write a static run of markup which begins with a start tag"""
+        if self.pending is not None:
+            self.out.append(self.pending + '>')
+            self.size += len(self.pending) + 1
+        elif self.texts:
+            self.flush_texts()
+        if markup:
+            self.out.append(markup)
+            self.size += len(markup)
+        self.pending = pending
+
+    def end(self, end_tag, markup, pending):
+        """write a static run of markup which begins with an end tag"""
+        if self.pending is not None:
+            # the element is empty
+            self.out.append(self.pending + '/>')
+            self.size += len(self.pending) + 2
+        else:
+            if self.texts:
+                self.flush_texts()
+            self.out.append(end_tag)
+            self.size += len(end_tag)
+        if markup:
+            self.out.append(markup)
+            self.size += len(markup)
+        self.pending = pending
+
+    def text(self, text):
+        """add text, which is escaped unless it is Markup"""
+        if self.pending is not None:
+            self.out.append(self.pending + '>')
+            self.size += len(self.pending) + 1
+            self.pending = None
+        self.texts.append(text)
+
+    def value(self, value):
+        """add the value of an expression"""
+        if value is None:
+            return
+        if isinstance(value, six.string_types):
+            self.text(value)
+        else:
+            for text in iter_value_texts(value):
+                self.text(text)
+
+    def attr(self, *values):
+        """return the value of an interpolated attribute, None if the
+        attribute must be left out"""
+        texts = []
+        for value in values:
+            if isinstance(value, six.string_types):
+                texts.append(value)
+            else:
+                texts.extend(iter_value_texts(value, markup_events=True))
+        if not texts:
+            return None
+        return u''.join(texts)
+
+    def merge(self, attrs, value):
+        """apply a py:attrs directive, see genshi AttrsDirective"""
+        if not value:
+            return attrs
+        if isinstance(value, Stream):
+            try:
+                value = next(iter(value))
+            except StopIteration:
+                value = []
+        elif not isinstance(value, list):
+            value = value.items()
+        return Attrs(attrs) | [
+            (QName(name), v is not None and six.text_type(v).strip() or None)
+            for name, v in value
+        ]
+
+    def list_id(self, attrs):
+        """give a new xml:id to a list, see backends.ListIdFilter"""
+        self.lists += 1
+        return Attrs(attrs) | [(XML_ID, 'list%d' % self.lists)]
+
+    def dstart(self, head, attrs, prefixes):
+        """write a start tag which attributes are known at render time
+
+        @param head: the start of the tag: its name and the namespace
+        declarations
+        @param attrs: the attributes, the ones with a None value are left out
+        @param prefixes: the prefixes of the namespaces at this element
+        """
+        declarations = []
+        buf = []
+        for name, value in attrs:
+            if value is None:
+                continue
+            uri = name.namespace
+            if uri:
+                prefix = prefixes.get(uri)
+                if prefix is None:
+                    prefix = self.generated.get(uri)
+                if prefix is None:
+                    prefix = 'ns%d' % (len(self.generated) + 1)
+                    self.generated[uri] = prefix
+                    declarations.append(
+                        ' xmlns:%s="%s"' % (prefix, escape(uri))
+                    )
+                if prefix:
+                    name = '%s:%s' % (prefix, name.localname)
+                else:
+                    name = name.localname
+            buf.append(' %s="%s"' % (name, escape(value)))
+        self.start('', head + ''.join(declarations) + ''.join(buf))
+
+    def take(self):
+        """return the markup written so far"""
+        data = u''.join(self.out)
+        self.out = []
+        self.size = 0
+        return data
+
+    def finish(self):
+        """return the rest of the markup"""
+        if self.pending is not None:
+            self.out.append(self.pending + '>')
+            self.pending = None
+        if self.texts:
+            self.flush_texts()
+        return self.take()
+
+
+class Element(object):
+    """an element of the template, before code generation"""
+
+    def __init__(self, tag, attrs, declarations, pos):
+        self.tag = tag
+        self.attrs = []
+        self.directives = {}
+        self.declarations = declarations
+        self.children = []
+        self.pos = pos
+
+        strip = tag.namespace == DIRECTIVE_NAMESPACE
+        if strip:
+            # <py:for each="...">
+            name = tag.localname
+            if name not in ELEMENT_DIRECTIVES:
+                raise UnsupportedTemplate("py:%s element" % name)
+            self.directives[name] = attrs.get(ELEMENT_DIRECTIVES[name])
+            self.directives['strip'] = ''
+
+        for name, value in attrs:
+            if name.namespace == DIRECTIVE_NAMESPACE:
+                if name.localname not in DIRECTIVES:
+                    raise UnsupportedTemplate(
+                        "py:%s directive" % name.localname
+                    )
+                self.directives[name.localname] = value
+            elif not strip:
+                if name == XML_SPACE:
+                    raise UnsupportedTemplate("xml:space attribute")
+                self.attrs.append((name, value))
+
+
+class NamespaceScope(object):
+    """the prefixes Genshi gives to the namespaces along the document, see
+    genshi.output.NamespaceFlattener"""
+
+    def __init__(self):
+        self.namespaces = {XML_NAMESPACE.uri: ['xml']}
+        self.prefixes = {'xml': [XML_NAMESPACE.uri]}
+
+    def push(self, prefix, uri):
+        """declare a namespace, return the declaration to add to the start
+        tag if any"""
+        declaration = None
+        if uri not in self.namespaces:
+            declaration = ('xmlns%s' % (prefix and ':%s' % prefix or ''), uri)
+        self.namespaces.setdefault(uri, []).append(prefix)
+        self.prefixes.setdefault(prefix, []).append(uri)
+        return declaration
+
+    def pop(self, prefix):
+        if prefix not in self.prefixes:
+            return
+        uris = self.prefixes[prefix]
+        uri = uris.pop()
+        if not uris:
+            del self.prefixes[prefix]
+        if uri not in uris or uri != uris[-1]:
+            uri_prefixes = self.namespaces[uri]
+            uri_prefixes.pop()
+            if not uri_prefixes:
+                del self.namespaces[uri]
+
+    def get_prefixes(self):
+        return dict(
+            (uri, prefixes[-1]) for uri, prefixes in self.namespaces.items()
+        )
+
+    def get_name(self, name):
+        """the prefixed name of a tag or attribute"""
+        uri = name.namespace
+        if not uri:
+            return name.localname
+        if uri not in self.namespaces:
+            raise UnsupportedTemplate("undeclared namespace %s" % uri)
+        prefix = self.namespaces[uri][-1]
+        if prefix:
+            return '%s:%s' % (prefix, name.localname)
+        return name.localname
+
+
+def build_tree(events):
+    """return the root elements and texts of a markup stream"""
+    root = []
+    stack = [(None, root)]
+    declarations = []
+    for kind, data, pos in events:
+        if kind is START:
+            tag, attrs = data
+            element = Element(tag, attrs, declarations, pos)
+            declarations = []
+            stack[-1][1].append(element)
+            stack.append((element, element.children))
+        elif kind is END:
+            stack.pop()
+        elif kind is TEXT:
+            stack[-1][1].append(data)
+        elif kind is START_NS:
+            if data[1] != DIRECTIVE_NAMESPACE:
+                declarations.append(data)
+        elif kind is END_NS:
+            pass
+        else:
+            raise UnsupportedTemplate("%s event" % kind)
+    return root
+
+
+class CodeGenerator(object):
+    """generate the Python source of the render function of a document"""
+
+    def __init__(self, lookup, list_tag=None):
+        self.lookup = lookup
+        self.list_tag = list_tag
+        self.scope = NamespaceScope()
+        self.constants = {}
+        self.names = {}
+        self.counter = 0
+
+    def constant(self, value):
+        """return the name of a global holding the value"""
+        key = (type(value), value)
+        name = self.names.get(key)
+        if name is None:
+            name = '_k%d' % len(self.names)
+            self.names[key] = name
+            self.constants[name] = value
+        return name
+
+    def new_name(self, prefix):
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def expression(self, source):
+        return get_expression_code(source)
+
+    def interpolate(self, text):
+        """return the parts of a text as a string or a list of ('text', str)
+        and ('expr', code) tuples"""
+        parts = []
+        for kind, data, pos in interpolate(text, lookup=self.lookup):
+            if kind is EXPR:
+                parts.append(('expr', self.expression(data.source)))
+            else:
+                parts.append(('text', data))
+        if len(parts) == 1 and parts[0][0] == 'text':
+            return parts[0][1]
+        return parts
+
+    def directive_value(self, element, name):
+        value = element.directives[name]
+        if value:
+            value = self.interpolate(value)
+            if not isinstance(value, six.string_types):
+                raise UnsupportedTemplate("expression in py:%s" % name)
+        return value
+
+    # the operations are ('start', markup), ('end', markup), ('text',
+    # markup), ('line', code) and ('block', code, operations)
+
+    def nodes(self, nodes):
+        ops = []
+        for node in nodes:
+            if isinstance(node, Element):
+                ops.extend(self.element(node))
+            else:
+                parts = self.interpolate(node)
+                if isinstance(parts, six.string_types):
+                    parts = [('text', parts)]
+                for kind, data in parts:
+                    if kind == 'text':
+                        ops.append(('text', escape(data, quotes=False)))
+                    else:
+                        ops.append(('line', '_value(%s)' % data))
+        return ops
+
+    def element(self, element):
+        directives = element.directives
+        if element.declarations and directives:
+            raise UnsupportedTemplate("namespace declared on a directive")
+
+        declarations = []
+        for prefix, uri in element.declarations:
+            declaration = self.scope.push(prefix, uri)
+            if declaration is not None:
+                declarations.append(declaration)
+
+        strip = directives.get('strip')
+        if strip is not None:
+            strip = self.directive_value(element, 'strip')
+            if not strip:
+                strip = True
+            else:
+                try:
+                    strip = bool(ast.literal_eval(strip))
+                except (ValueError, SyntaxError):
+                    strip = self.expression(strip)
+
+        if 'replace' in directives:
+            if set(directives) & set(['content', 'attrs', 'strip']):
+                raise UnsupportedTemplate("py:replace with other directives")
+            value = self.directive_value(element, 'replace')
+            ops = [('line', '_value(%s)' % self.expression(value))]
+        else:
+            if strip is True:
+                start = end = []
+            else:
+                start = self.start_tag(element, declarations)
+                end = [('end', '</%s>' % self.scope.get_name(element.tag))]
+                if strip:
+                    # stripped depending on the data
+                    name = self.new_name('_s')
+                    start = [
+                        ('line', '%s = %s' % (name, strip)),
+                        ('block', 'if not %s:' % name, start),
+                    ]
+                    end = [('block', 'if not %s:' % name, end)]
+
+            if 'content' in directives:
+                value = self.directive_value(element, 'content')
+                content = [('line', '_value(%s)' % self.expression(value))]
+            else:
+                content = self.nodes(element.children)
+            ops = start + content + end
+
+        if 'if' in directives:
+            value = self.directive_value(element, 'if')
+            ops = [('block', 'if %s:' % self.expression(value), ops)]
+
+        if 'for' in directives:
+            ops = self.loop(self.directive_value(element, 'for'), ops)
+
+        for prefix, uri in element.declarations:
+            self.scope.pop(prefix)
+        return ops
+
+    def loop(self, value, body):
+        if ' in ' not in value:
+            raise UnsupportedTemplate("'in' missing in py:for")
+        target, iterable = value.split(' in ', 1)
+        names = get_assignment(target)
+        iterable = self.expression(iterable)
+
+        scope = self.new_name('_scope')
+        item = self.new_name('_item')
+        assignments = []
+
+        def assign(names, value):
+            if isinstance(names, tuple):
+                for index, name in enumerate(names):
+                    assign(name, '%s[%d]' % (value, index))
+            else:
+                assignments.append(
+                    ('line', '%s[%r] = %s' % (scope, names, value))
+                )
+        assign(names, item)
+
+        flush = ('block', 'if _w.size >= _flush_size:', [
+            ('line', 'yield _w.take()'),
+        ])
+        return [
+            ('line', '%s = {}' % scope),
+            ('line', '__data__.push(%s)' % scope),
+            ('block', 'for %s in iter(%s):' % (item, iterable),
+             assignments + body + [flush]),
+            ('line', '__data__.pop()'),
+        ]
+
+    def start_tag(self, element, declarations):
+        name = self.scope.get_name(element.tag)
+        head = '<' + name + ''.join(
+            ' %s="%s"' % (attr, escape(value)) for attr, value in declarations
+        )
+
+        attrs = []
+        dynamic = 'attrs' in element.directives or (
+            element.tag == self.list_tag
+        )
+        for attr, value in element.attrs:
+            if value:
+                value = self.interpolate(value)
+            if isinstance(value, six.string_types):
+                attrs.append((attr, value, None))
+            else:
+                dynamic = True
+                codes = [
+                    self.constant(data) if kind == 'text' else data
+                    for kind, data in value
+                ]
+                attrs.append((attr, None, '_w.attr(%s)' % ', '.join(codes)))
+
+        if not dynamic:
+            for attr, value, code in attrs:
+                head += ' %s="%s"' % (self.scope.get_name(attr), escape(value))
+            return [('start', head)]
+
+        code = '[%s]' % ', '.join(
+            '(%s, %s)' % (
+                self.constant(attr),
+                self.constant(value) if code is None else code
+            )
+            for attr, value, code in attrs
+        )
+        if 'attrs' in element.directives:
+            value = self.directive_value(element, 'attrs')
+            code = '_w.merge(%s, %s)' % (code, self.expression(value))
+        if element.tag == self.list_tag:
+            code = '_w.list_id(%s)' % code
+        prefixes = self.constant(tuple(sorted(
+            self.scope.get_prefixes().items()
+        )))
+        return [('line', '_w.dstart(%s, %s, _prefixes[%s])' % (
+            self.constant(head), code, prefixes
+        ))]
+
+    # code generation
+
+    def generate(self, root):
+        ops = self.nodes(root)
+        lines = [
+            'def render(__data__, _w, _flush_size):',
+            '    _value = _w.value',
+            '    _text = _w.text',
+            '    _start = _w.start',
+            '    _end = _w.end',
+        ]
+        self.write(ops, lines, 1)
+        lines.append('    yield _w.finish()')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, ops, lines, indent):
+        pad = '    ' * indent
+        run = []
+        for op in ops:
+            kind = op[0]
+            if kind in ('start', 'end', 'text'):
+                run.append(op)
+                continue
+            if run:
+                self.write_run(run, lines, pad)
+                run = []
+            if kind == 'line':
+                lines.append(pad + op[1])
+            else:
+                lines.append(pad + op[1])
+                count = len(lines)
+                self.write(op[2], lines, indent + 1)
+                if len(lines) == count:
+                    lines.append(pad + '    pass')
+        if run:
+            self.write_run(run, lines, pad)
+
+    def write_run(self, run, lines, pad):
+        """write the calls of a run of static operations, serialized as
+        much as possible at compile time"""
+        index = 0
+        texts = []
+        while index < len(run) and run[index][0] == 'text':
+            texts.append(run[index][1])
+            index += 1
+        if texts:
+            lines.append(pad + '_text(%s)' % self.constant(
+                Markup(u''.join(texts))
+            ))
+        if index == len(run):
+            return
+
+        first_kind, first_markup = run[index]
+        out = []
+        texts = []
+        pending = first_markup if first_kind == 'start' else None
+        for kind, markup in run[index + 1:]:
+            if kind == 'start':
+                if pending is not None:
+                    out.append(pending + '>')
+                elif texts:
+                    out.append(normalize_space(u''.join(texts)))
+                    texts = []
+                pending = markup
+            elif kind == 'end':
+                if pending is not None:
+                    out.append(pending + '/>')
+                    pending = None
+                else:
+                    if texts:
+                        out.append(normalize_space(u''.join(texts)))
+                        texts = []
+                    out.append(markup)
+            else:
+                if pending is not None:
+                    out.append(pending + '>')
+                    pending = None
+                texts.append(markup)
+
+        pending = 'None' if pending is None else self.constant(pending)
+        markup = self.constant(u''.join(out))
+        if first_kind == 'start':
+            lines.append(pad + '_start(%s, %s)' % (markup, pending))
+        else:
+            lines.append(pad + '_end(%s, %s, %s)' % (
+                self.constant(first_markup), markup, pending
+            ))
+        if texts:
+            lines.append(pad + '_text(%s)' % self.constant(
+                Markup(u''.join(texts))
+            ))
+
+
+class FastTemplate(object):
+    """A prepared document compiled into a Python generator.
+
+    It is used like a Genshi MarkupTemplate, but its generate method
+    returns the serialized document by blocks of text instead of a stream
+    of markup events.
+    """
+
+    def __init__(self, events, lookup='strict', list_tag=None,
+                 flush_size=65536, filename=None):
+        """
+        @param events: the markup events of the prepared document, see
+        py3o.template.main.iter_genshi_events
+        @type events: iterable
+
+        @param lookup: the Genshi variable lookup, 'strict' or 'lenient'
+        @type lookup: string
+
+        @param list_tag: the lists which get a new xml:id at each render,
+        like py3o.template.backends.ListIdFilter gives
+        @type list_tag: genshi.core.QName
+
+        @param flush_size: the number of characters written before the
+        generator yields, in the loops of the document
+        @type flush_size: int
+
+        @raises: UnsupportedTemplate when the document uses a feature this
+        engine does not implement
+        """
+        self.lookup = lookup
+        self.flush_size = flush_size
+        generator = CodeGenerator(lookup, list_tag)
+        self.source = generator.generate(build_tree(events))
+
+        lookup_class = {
+            'lenient': LenientLookup, 'strict': StrictLookup,
+        }[lookup]
+        namespace = {
+            '_lookup_name': lookup_class.lookup_name,
+            '_lookup_attr': lookup_class.lookup_attr,
+            '_lookup_item': lookup_class.lookup_item,
+            'UndefinedError': UndefinedError,
+            '_prefixes': dict(
+                (value, dict(value))
+                for value in generator.constants.values()
+                if isinstance(value, tuple)
+            ),
+        }
+        namespace.update(generator.constants)
+        code = compile(
+            self.source, '<py3o %s>' % (filename or 'template'), 'exec'
+        )
+        six.exec_(code, namespace)
+        self.function = namespace['render']
+
+    def generate(self, *args, **data):
+        """render the document with the data
+
+        @returns: an iterator on the serialized document, by blocks
+        """
+        if args:
+            context = args[0]
+        else:
+            context = Context(**data)
+        return self.function(context, Writer(), self.flush_size)
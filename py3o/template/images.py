@@ -0,0 +1,570 @@
+# -*- encoding: utf-8 -*-
+"""Storage of the images added to the rendered documents.
+
+Images given to a template are kept until the output archive is written.
+Small images stay in memory, larger ones are spilled to a temporary
+directory and streamed into the archive from there, so the memory used by
+a render does not grow with the volume of its images. Images given by path
+or by a function are only read when the archive is written.
+
+An :class:`ImagePool` shared by the templates of a process remembers the
+identifiers of the images already seen, and keeps one copy of their content
+for all the renders using them.
+"""
+import binascii
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from base64 import b64decode
+from collections import OrderedDict
+from io import BytesIO
+
+import six
+
+# images larger than this are spilled to disk by default
+SPILL_SIZE = 1024 * 1024
+
+# the default size of the image content kept by an ImagePool
+POOL_SIZE = 64 * 1024 * 1024
+
+# base64 images are decoded by chunks of this many characters
+B64_CHUNK_SIZE = 64 * 1024
+
+# the bytes b64decode skips
+NOT_BASE64 = bytes(bytearray(
+    c for c in range(256)
+    if c not in bytearray(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                          b'abcdefghijklmnopqrstuvwxyz0123456789+/=')
+))
+
+
+def is_image_path(data, isb64=False):
+    """tell if the data given for an image is the path of its file: a path
+    object, or a text string (on Python 2 only unicode strings, str being
+    bytes) unless the data is base64 encoded
+    """
+    path_like = getattr(os, 'PathLike', None)
+    if path_like is not None and isinstance(data, path_like):
+        return True
+    return isinstance(data, six.text_type) and not isb64
+
+
+def as_buffer(data):
+    """return bytes-like image data as something zipfile and zlib can use
+    without copying it
+    """
+    if isinstance(data, (six.binary_type, six.text_type, bytearray)):
+        return data
+    if six.PY3:
+        # any object supporting the buffer protocol, like a memoryview, an
+        # array or a mmap, has a byte length different from its len()
+        return memoryview(data).cast('B')
+    return data  # pragma: no cover
+
+
+def iter_b64decode(data, chunk_size=B64_CHUNK_SIZE):
+    """decode base64 data by chunks, like b64decode does at once
+
+    @param data: the base64 encoded data
+    @type data: string or bytes-like object
+
+    @returns: an iterator on the decoded chunks
+    """
+    pending = b''
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('ascii')
+        chunk = pending + bytes(chunk).translate(None, NOT_BASE64)
+        # decode whole groups of 4 characters, keep the others for later
+        end = len(chunk) - len(chunk) % 4
+        pending = chunk[end:]
+        if end:
+            yield binascii.a2b_base64(chunk[:end])
+    if pending:
+        # incorrect padding
+        yield binascii.a2b_base64(pending)
+
+
+def get_path_key(path):
+    """return the (path, mtime, size) tuple identifying a version of a
+    file"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, stat.st_mtime, stat.st_size
+
+
+def get_path_identifier(path, by_content=False):
+    """identify an image file from its path, modification time and size
+    instead of hashing its content
+
+    @param by_content: hash the content of the file instead, by chunks. The
+    identifier is then the one of the same image given as data.
+    @type by_content: bool
+    """
+    if by_content:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(B64_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    key = u"%s:%s:%s" % get_path_key(path)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_data_identifier(data, isb64=False):
+    """identify an image from its content
+
+    @returns: an (identifier, data) tuple where data is the decoded content
+    """
+    if isb64:
+        data = b64decode(data)
+    return hashlib.sha256(data).hexdigest(), data
+
+
+class ImagePool(object):
+    """A thread safe LRU cache of image identifiers and contents, shared by
+    the renders of a process.
+
+    Immutable image data (bytes and base64 text) is remembered by object
+    identity, so the same object given to many renders is hashed and
+    decoded once. Images given by path are remembered by path, modification
+    time and size, along with the digest of their content if they are
+    identified by content. The content of each image is kept once and handed to
+    every render using it, instead of a copy per render.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=POOL_SIZE):
+        """
+        @param max_entries: the maximum number of images and of source
+        objects remembered
+        @type max_entries: int
+
+        @param max_bytes: the maximum size of the image contents and base64
+        sources kept. No limit if None.
+        @type max_bytes: int or None. Default is 64 MiB
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+
+        # (id(source), isb64) -> (source, identifier, size)
+        self._sources = OrderedDict()
+        # identifier -> (data, mime_type)
+        self._images = OrderedDict()
+        # (path, mtime, size, by_content) -> identifier
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, data, isb64=False, mime_type=None):
+        """identify image content, hashing and decoding it only if it was
+        not seen yet
+
+        @param data: the content of the image, base64 encoded if isb64
+        @type data: bytes-like object or string
+
+        @returns: an (identifier, data, mime_type, shared) tuple where data
+        is the decoded content, the pooled copy when shared is True. The
+        mime type defaults to the one given with the image before.
+        """
+        # only immutable objects can be remembered by identity, keeping a
+        # reference to them prevents their id from being reused
+        remember = isinstance(data, (six.binary_type, six.text_type))
+        key = (id(data), bool(isb64))
+
+        with self._lock:
+            source = self._sources.get(key) if remember else None
+            if source is not None:
+                self.hits += 1
+                identifier = source[1]
+                self._sources[key] = self._sources.pop(key)
+                image = self._images.pop(identifier)
+                self._images[identifier] = image
+                return identifier, image[0], mime_type or image[1], True
+            self.misses += 1
+
+        # hash outside the lock, the worst case is two threads hashing the
+        # same image and sharing the copy of the first one
+        identifier, content = get_data_identifier(data, isb64)
+
+        with self._lock:
+            image = self._images.pop(identifier, None)
+            if image is None:
+                if not isinstance(content, six.binary_type):
+                    # a mutable buffer could change under the other renders
+                    return identifier, content, mime_type, False
+                image = (content, mime_type)
+                self.total_bytes += len(content)
+            self._images[identifier] = image
+
+            if remember and key not in self._sources:
+                # the source costs nothing more when it is the content
+                size = 0 if data is image[0] else len(data)
+                self._sources[key] = (data, identifier, size)
+                self.total_bytes += size
+
+            self._evict()
+            shared = identifier in self._images
+        return identifier, image[0], mime_type or image[1], shared
+
+    def get_path(self, path, by_content=False):
+        """return the identifier of an image file, see get_path_identifier"""
+        key = get_path_key(path) + (bool(by_content),)
+        with self._lock:
+            identifier = self._paths.pop(key, None)
+            if identifier is not None:
+                self.hits += 1
+                self._paths[key] = identifier
+                return identifier
+            self.misses += 1
+
+        identifier = get_path_identifier(path, by_content)
+        with self._lock:
+            self._paths[key] = identifier
+            while len(self._paths) > self.max_entries:
+                self._paths.popitem(last=False)
+                self.evictions += 1
+        return identifier
+
+    def clear(self):
+        """forget every image, counters are kept"""
+        with self._lock:
+            self._sources.clear()
+            self._images.clear()
+            self._paths.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """return the pool counters as a dictionary"""
+        return {
+            'entries': len(self._images),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _evict(self):
+        # called with the lock held, every remembered source must point to
+        # a pooled image
+        while len(self._sources) > self.max_entries:
+            _, (_, _, size) = self._sources.popitem(last=False)
+            self.total_bytes -= size
+
+        while self._images and (
+            len(self._images) > self.max_entries or (
+                self.max_bytes is not None and
+                self.total_bytes > self.max_bytes
+            )
+        ):
+            identifier, (data, _) = self._images.popitem(last=False)
+            self.total_bytes -= len(data)
+            self.evictions += 1
+            for key, (_, source_identifier, size) in list(
+                self._sources.items()
+            ):
+                if source_identifier == identifier:
+                    del self._sources[key]
+                    self.total_bytes -= size
+
+
+class StoredImage(object):
+    """an image of an ImageStore, its content comes from one of data, path
+    or loader
+    """
+
+    def __init__(self, mime_type=None, data=None, path=None, loader=None,
+                 size=None, temporary=False):
+        """
+        @param mime_type: the type of the image, like 'image/png' or 'png'
+        @type mime_type: string
+
+        @param data: the content of an image kept in memory
+        @type data: bytes-like object
+
+        @param path: the file holding the content of the image
+        @type path: string
+
+        @param loader: a function without argument returning the content of
+        the image, as bytes or a binary file object
+        @type loader: callable
+
+        @param size: the size of the image in bytes, when known
+        @type size: int
+
+        @param temporary: path is a spilled copy, removed with the image
+        @type temporary: bool
+        """
+        self.mime_type = mime_type
+        self.data = data
+        self.path = path
+        self.loader = loader
+        self.size = size
+        self.temporary = temporary
+
+    @property
+    def in_memory(self):
+        return self.data is not None
+
+    def open(self):
+        """return a binary file object to read the image from"""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        if self.loader is not None:
+            content = self.loader()
+            if hasattr(content, 'read'):
+                return content
+            return BytesIO(content)
+        return BytesIO(self.data)
+
+    def read(self):
+        """return the content of the image"""
+        if self.data is not None:
+            return self.data
+        source = self.open()
+        try:
+            return source.read()
+        finally:
+            source.close()
+
+
+class ImageStore(object):
+    """The images of a render, by identifier.
+
+    Images given as data up to spill_size bytes are kept in memory, the
+    others are written to a temporary directory which is removed by close().
+    """
+
+    def __init__(self, spill_size=SPILL_SIZE, directory=None, pool=None,
+                 deterministic=False):
+        """
+        @param spill_size: the size in bytes from which images are spilled
+        to disk, None to keep every image in memory
+        @type spill_size: int. Default is 1 MiB
+
+        @param directory: where to create the temporary directory of the
+        spilled images
+        @type directory: string. Default is the system temporary directory
+
+        @param pool: identifies the images and shares their content with
+        the other stores using it. The images it keeps are not spilled.
+        @type pool: ImagePool or None
+
+        @param deterministic: identify the image files by their content
+        rather than by their path, modification time and size
+        @type deterministic: bool. Default is False
+        """
+        self.spill_size = spill_size
+        self.directory = directory
+        self.pool = pool
+        self.deterministic = deterministic
+        self.spill_dir = None
+        self.images = {}
+        self.loaded_images = 0
+        # (path, mtime, size) -> identifier of the files hashed without pool
+        self.file_digests = {}
+
+    def new(self):
+        """return an empty store with the same settings"""
+        return ImageStore(
+            self.spill_size, self.directory, self.pool, self.deterministic
+        )
+
+    def new_identifier(self):
+        """return an identifier for an image which content is not known
+        yet, unique in this store
+        """
+        self.loaded_images += 1
+        return 'py3o-image-%d' % self.loaded_images
+
+    def add_content(self, data, mime_type=None, isb64=False):
+        """add an image identified by its content, unless it is already in
+        the store
+
+        @param data: the content of the image, base64 encoded if isb64
+        @type data: bytes-like object or string
+
+        @returns: the identifier of the image
+        """
+        data = as_buffer(data)
+        if isb64 and self.is_spilled(len(data) // 4 * 3):
+            return self.add_encoded(data, mime_type)
+
+        if self.pool is None:
+            identifier, data = get_data_identifier(data, isb64)
+            if identifier not in self.images:
+                self.add(identifier, data, mime_type)
+            return identifier
+
+        identifier, data, mime_type, shared = self.pool.get(
+            data, isb64, mime_type
+        )
+        if identifier not in self.images:
+            if shared:
+                self.images[identifier] = StoredImage(
+                    mime_type, data=data, size=len(data)
+                )
+            else:
+                self.add(identifier, data, mime_type)
+        return identifier
+
+    def is_spilled(self, size):
+        """tell if an image of this size is kept on disk: it is larger than
+        spill_size and cannot be kept in memory by the pool either
+        """
+        if self.spill_size is None or size <= self.spill_size:
+            return False
+        return self.pool is None or (
+            self.pool.max_bytes is not None and size > self.pool.max_bytes
+        )
+
+    def add_encoded(self, data, mime_type=None):
+        """add a base64 encoded image, decoded by chunks into the hash and
+        a spilled file so only a chunk of it is in memory at a time
+
+        @returns: the identifier of the image
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(dir=self.get_spill_dir())
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_b64decode(data):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.unlink(path)
+            raise
+
+        identifier = digest.hexdigest()
+        if identifier in self.images:
+            os.unlink(path)
+        else:
+            self.images[identifier] = StoredImage(
+                mime_type, path=path, size=size, temporary=True
+            )
+        return identifier
+
+    def add_file(self, path, mime_type=None):
+        """add an image file identified by its path, modification time and
+        size, or by its content when the store is deterministic, unless it
+        is already in the store
+
+        @returns: the identifier of the image
+        """
+        if self.pool is not None:
+            identifier = self.pool.get_path(path, self.deterministic)
+        elif self.deterministic:
+            key = get_path_key(path)
+            identifier = self.file_digests.get(key)
+            if identifier is None:
+                identifier = get_path_identifier(path, by_content=True)
+                self.file_digests[key] = identifier
+        else:
+            identifier = get_path_identifier(path)
+        if identifier not in self.images:
+            self.add_path(identifier, path, mime_type)
+        return identifier
+
+    def add(self, identifier, data, mime_type=None):
+        """add or replace an image
+
+        @param identifier: the name of the image in the archive
+        @type identifier: string
+
+        @param data: the content of the image
+        @type data: bytes, bytearray or memoryview
+        """
+        self.discard(identifier)
+        data = as_buffer(data)
+
+        if self.spill_size is None or len(data) <= self.spill_size:
+            image = StoredImage(mime_type, data=data, size=len(data))
+        else:
+            fd, path = tempfile.mkstemp(dir=self.get_spill_dir())
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            image = StoredImage(
+                mime_type, path=path, size=len(data), temporary=True
+            )
+
+        self.images[identifier] = image
+
+    def add_path(self, identifier, path, mime_type=None):
+        """add or replace an image read from a file when the archive is
+        written
+
+        @param path: the path of the image file
+        @type path: string or path object
+        """
+        self.discard(identifier)
+        if hasattr(os, 'fspath'):
+            path = os.fspath(path)
+        self.images[identifier] = StoredImage(
+            mime_type, path=path, size=os.path.getsize(path)
+        )
+
+    def add_loader(self, identifier, loader, mime_type=None):
+        """add or replace an image which content is given by a function
+        called when the archive is written
+
+        @param loader: a function without argument returning the content of
+        the image, as bytes or a binary file object
+        @type loader: callable
+        """
+        self.discard(identifier)
+        self.images[identifier] = StoredImage(mime_type, loader=loader)
+
+    def discard(self, identifier):
+        """remove an image if it is in the store"""
+        image = self.images.pop(identifier, None)
+        if image is not None and image.temporary:
+            os.unlink(image.path)
+
+    def get_spill_dir(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(
+                prefix='py3o-images-', dir=self.directory
+            )
+        return self.spill_dir
+
+    def close(self):
+        """forget every image and remove the spilled ones"""
+        self.images = {}
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    def __del__(self):
+        self.close()
+
+    def get(self, identifier, default=None):
+        return self.images.get(identifier, default)
+
+    def __getitem__(self, identifier):
+        return self.images[identifier]
+
+    def __contains__(self, identifier):
+        return identifier in self.images
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __len__(self):
+        return len(self.images)
+
+    def keys(self):
+        return self.images.keys()
+
+    def items(self):
+        return self.images.items()
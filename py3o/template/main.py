@@ -4,28 +4,39 @@ import logging
 import warnings
 from datetime import datetime
 import os
+import time
 import traceback
-import hashlib
 import six
-from base64 import b64decode
 import re
 
 import lxml.etree
 import zipfile
 
-from copy import copy
+from copy import copy, deepcopy
 from io import BytesIO
-from uuid import uuid4
 import codecs
+from collections import namedtuple
+from functools import partial
 
 from six.moves import urllib
 
-from genshi.template import MarkupTemplate
+from genshi.core import Attrs, QName
+from genshi.core import START, END, TEXT, START_NS, END_NS, COMMENT, PI
 from genshi.template.text import NewTextTemplate as GenshiTextTemplate
-from genshi.filters.transform import Transformer
 
 from pyjon.utils import get_secure_filename
 
+from py3o.template.archive import (
+    FIXED_DATE_TIME, ZIP_STREAMING, CompressionPolicy,
+    write_deflated_blocks, write_deflated_member, write_file_member,
+)
+from py3o.template.backends import (
+    DEFAULT_BACKEND, UnsupportedTemplate, get_backend,
+)
+from py3o.template.images import (
+    SPILL_SIZE, ImageStore, is_image_path,
+)
+
 if six.PY3:  # pragma: no cover
     # in python 3 we want to emulate  binary files
     from six import BytesIO as StringIO
@@ -60,6 +71,50 @@ class TemplateException(ValueError):
         return self.message
 
 
+# a document compiled by a render backend, see Template.__compile_trees
+PreparedDocument = namedtuple('PreparedDocument', ['backend', 'document'])
+
+# what render_flow yields when asked for progress:
+# phase: 'prepare', 'generate' (a document starts being rendered),
+#        'serialize' (a block of a document was written) or 'zip' (a
+#        member was copied or added, or the archive was closed)
+# member: the name of the archive member, None for the whole document
+# bytes_written: the uncompressed size of what was written so far
+# elapsed: the seconds since the rendering started
+# iterations: the number of py:for loop iterations done so far
+RenderProgress = namedtuple(
+    'RenderProgress',
+    ['phase', 'member', 'bytes_written', 'elapsed', 'iterations']
+)
+
+
+def is_path(value):
+    """tell if a template or output argument is a file path: a string or a
+    path object, rather than a file object or bytes
+    """
+    path_like = getattr(os, 'PathLike', None)
+    if path_like is not None and isinstance(value, path_like):
+        return True
+    return isinstance(value, six.string_types)
+
+
+def get_template_file(template):
+    """return something zipfile or open() can read a template from
+
+    @param template: the path of a template file, a binary file object or
+    the template content itself
+    @type template: string, file object, bytes, bytearray or memoryview
+    """
+    if isinstance(template, memoryview):
+        return BytesIO(template.tobytes())
+    # on Python 2 a str is a path
+    if isinstance(template, bytearray) or (
+        six.PY3 and isinstance(template, bytes)
+    ):
+        return BytesIO(template)
+    return template
+
+
 def detect_keep_boundary(start, end, namespaces):
     """a helper to inspect a link and see if we should keep the link boundary
     """
@@ -142,43 +197,50 @@ def move_siblings(
         old_.remove(end)
 
 
-def get_list_transformer(namespaces):
-    """this function returns a transformer to
-     find all list elements and recompute their xml:id.
-    Because if we duplicate lists we create invalid XML.
-    Each list must have its own xml:id
+# a Genshi expression in a table cell text or formula
+CELL_EXPRESSION_RE = re.compile(r'\${[^\${}]*}')
 
-    This is important if you want to be able to reopen the produced
-     document wih an XML parser. LibreOffice will fix those ids itself
-     silently, but lxml.etree.parse will bork on such duplicated lists
+
+def get_first_text(element):
+    """return the first text node of element, the one an XPath string
+    function gives for text(): its text, else the first tail of its
+    children. None when it has no text at all.
     """
-    return Transformer(
-        '//list[namespace-uri()="%s"]' % namespaces.get(
-            'text'
-        )
-    ).attr(
-        '{0}id'.format(XML_NS),
-        lambda *args: "list{0}".format(uuid4().hex)
-    )
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
 
 
 def get_all_python_expression(content_trees, namespaces):
     """Return all the python expressions found in the whole document
     """
+    # only cells containing "${" are candidates, the regular expression is
+    # then checked in python: EXSLT regexp:match would call back python for
+    # every table cell of the document
     xpath_expr = (
         "//text:a[starts-with(@xlink:href, 'py3o://')] | "
         "//text:user-field-get[starts-with(@text:name, 'py3o.')] | "
-        "//table:table-cell/text:p[regexp:match(text(), '\${[^\${}]*}')] | "
-        "//table:table-cell[regexp:match(@table:formula, '\${[^\${}]*}')]"
+        "//table:table-cell/text:p[contains(text(), '${')] | "
+        "//table:table-cell[contains(@table:formula, '${')]"
     )
+    p_tag = '{%s}p' % namespaces['text']
+    cell_tag = '{%s}table-cell' % namespaces['table']
+    formula_attr = '{%s}formula' % namespaces['table']
+
     res = []
     for content_tree in content_trees:
-        res.extend(
-            content_tree.xpath(
-                xpath_expr,
-                namespaces=namespaces,
-            )
-        )
+        for node in content_tree.xpath(xpath_expr, namespaces=namespaces):
+            if node.tag == p_tag:
+                text = get_first_text(node)
+                if text is None or not CELL_EXPRESSION_RE.search(text):
+                    continue
+            elif node.tag == cell_tag:
+                if not CELL_EXPRESSION_RE.search(node.get(formula_attr)):
+                    continue
+            res.append(node)
     return res
 
 
@@ -218,6 +280,256 @@ def get_soft_breaks(content_tree, namespaces):
     )
 
 
+class DirectiveIndex(object):
+    """All the py3o related nodes of a content tree, found in a single walk.
+
+    Nodes are recorded by category, in document order. The preparation
+    steps move and copy nodes around: removed subtrees must be given to
+    discard() and copied ones to add(). Nodes added later are appended at the
+    end of their category.
+    """
+
+    categories = (
+        'soft_breaks',      # text:soft-page-break
+        'instructions',     # text:a linking to py3o://
+        'image_frames',     # draw:frame named py3o.image(...)
+        'static_images',    # draw:frame named py3o.staticimage.*
+        'user_fields',      # text:user-field-decl named py3o.*
+        'user_texts',       # text:user-field-get named py3o.*
+        'formulas',         # table:table-cell with ${} in its formula
+        'expressions',      # every node holding a py3o expression
+    )
+
+    def __init__(self, content_tree, namespaces):
+        text = namespaces['text']
+        table = namespaces['table']
+        draw = namespaces['draw']
+
+        self.soft_break_tag = '{%s}soft-page-break' % text
+        self.link_tag = '{%s}a' % text
+        self.user_field_tag = '{%s}user-field-decl' % text
+        self.user_text_tag = '{%s}user-field-get' % text
+        self.frame_tag = '{%s}frame' % draw
+        self.cell_tag = '{%s}table-cell' % table
+        self.paragraph_tag = '{%s}p' % text
+        self.tags = (
+            self.soft_break_tag, self.link_tag, self.user_field_tag,
+            self.user_text_tag, self.frame_tag, self.cell_tag,
+            self.paragraph_tag,
+        )
+
+        self.href_attr = '{%s}href' % namespaces['xlink']
+        self.name_attr = '{%s}name' % text
+        self.frame_name_attr = '{%s}name' % draw
+        self.formula_attr = '{%s}formula' % table
+
+        for category in self.categories:
+            setattr(self, category, [])
+        self.known = set()
+        self.removed = set()
+
+        self.add(content_tree.getroot())
+
+    def add(self, element):
+        """index element and all its descendants"""
+        for node in element.iter(*self.tags):
+            if node in self.known:
+                continue
+            self.known.add(node)
+            tag = node.tag
+
+            if tag == self.soft_break_tag:
+                self.soft_breaks.append(node)
+
+            elif tag == self.link_tag:
+                if node.get(self.href_attr, '').startswith('py3o://'):
+                    self.instructions.append(node)
+                    self.expressions.append(node)
+
+            elif tag == self.user_text_tag:
+                if node.get(self.name_attr, '').startswith('py3o.'):
+                    self.user_texts.append(node)
+                    self.expressions.append(node)
+
+            elif tag == self.user_field_tag:
+                if node.get(self.name_attr, '').startswith('py3o.'):
+                    self.user_fields.append(node)
+
+            elif tag == self.frame_tag:
+                name = node.get(self.frame_name_attr, '')
+                if name.startswith('py3o.image'):
+                    self.image_frames.append(node)
+                elif name.startswith('py3o.staticimage'):
+                    self.static_images.append(node)
+
+            elif tag == self.cell_tag:
+                # the cheap substring test spares the regular expression
+                # to most cells
+                formula = node.get(self.formula_attr)
+                if formula and '${' in formula and (
+                    CELL_EXPRESSION_RE.search(formula)
+                ):
+                    self.formulas.append(node)
+                    self.expressions.append(node)
+
+            else:
+                text_ = get_first_text(node)
+                if text_ and '${' in text_:
+                    parent = node.getparent()
+                    if parent is not None and parent.tag == self.cell_tag and (
+                        CELL_EXPRESSION_RE.search(text_)
+                    ):
+                        self.expressions.append(node)
+
+    def discard(self, element):
+        """forget element and all its descendants"""
+        self.removed.update(element.iter(*self.tags))
+
+    def get(self, category):
+        """return the nodes of a category that are still in the tree"""
+        nodes = getattr(self, category)
+        if not self.removed:
+            return list(nodes)
+        return [node for node in nodes if node not in self.removed]
+
+
+def has_directives(content_tree, namespaces):
+    """tell if a prepared tree needs to be rendered by Genshi: it contains
+    Genshi directives, text or attributes that Genshi would interpolate or
+    static images whose link was replaced
+    """
+    xpath_expr = (
+        "boolean("
+        "//py:* | //@py:* | "
+        "//text()[contains(., '$')] | //@*[contains(., '$')] | "
+        "//draw:frame[starts-with(@draw:name, 'py3o.')]"
+        ")"
+    )
+    return content_tree.xpath(
+        xpath_expr,
+        namespaces=namespaces
+    )
+
+
+def iter_genshi_events(root, filename=None):
+    """generate the Genshi markup events of an lxml element and its
+    descendants, as genshi.input.XMLParser would do from its serialization
+
+    This spares the serialization of a prepared tree and its parsing by
+    Genshi when building a template. Positions refer to the lines of the
+    document lxml parsed the element from.
+    """
+    comment = lxml.etree.Comment
+    pi = lxml.etree.ProcessingInstruction
+
+    # (element, children iterator, namespace map, declared prefixes)
+    stack = [(None, iter([root]), {}, [])]
+    while stack:
+        parent, children, nsmap, prefixes = stack[-1]
+        child = next(children, None)
+
+        if child is None:
+            stack.pop()
+            if parent is not None:
+                pos = (filename, parent.sourceline or -1, -1)
+                yield END, QName(parent.tag), pos
+                for prefix in prefixes:
+                    yield END_NS, prefix, pos
+                if parent.tail:
+                    yield TEXT, parent.tail, pos
+            continue
+
+        pos = (filename, child.sourceline or -1, -1)
+        tag = child.tag
+
+        if tag is comment:
+            yield COMMENT, child.text or '', pos
+
+        elif tag is pi:
+            yield PI, (child.target, child.text or ''), pos
+
+        else:
+            child_nsmap = child.nsmap
+            declared = []
+            for prefix, uri in child_nsmap.items():
+                if nsmap.get(prefix) != uri:
+                    prefix = prefix or ''
+                    declared.append(prefix)
+                    yield START_NS, (prefix, uri), pos
+
+            attrs = Attrs([
+                (QName(name), value) for name, value in child.attrib.items()
+            ])
+            yield START, (QName(tag), attrs), pos
+            if child.text:
+                yield TEXT, child.text, pos
+
+            stack.append((child, iter(child), child_nsmap, declared))
+            # the tail comes after the END event
+            continue
+
+        if child.tail:
+            yield TEXT, child.tail, pos
+
+
+def wrap_loops(events, loop_function='__py3o_loop'):
+    """make the py:for directives of a markup stream iterate through a
+    function of the template data, to let it count the loop iterations
+
+    `py:for="item in items"` becomes
+    `py:for="item in __py3o_loop(items)"`, Genshi splits the directive on
+    the first " in " the same way.
+    """
+    for_name = QName('{%s}for' % GENSHI_URI)
+
+    def wrap(value):
+        if ' in ' not in value:
+            # let Genshi report the syntax error
+            return value
+        assign, iterable = value.split(' in ', 1)
+        return '%s in %s(%s)' % (assign, loop_function, iterable.strip())
+
+    for kind, data, pos in events:
+        if kind is START:
+            tag, attrs = data
+            if tag == for_name and attrs.get('each'):
+                attrs = attrs | [(QName('each'), wrap(attrs.get('each')))]
+                data = tag, attrs
+            elif for_name in attrs:
+                attrs = attrs | [(for_name, wrap(attrs.get(for_name)))]
+                data = tag, attrs
+        yield kind, data, pos
+
+
+def iter_encoded(chunks, flush_size, encoding='utf-8'):
+    """join the text chunks of a serialized stream into encoded blocks
+
+    Genshi serializes a document in many small strings, encoding and
+    writing them one by one costs more than the serialization itself.
+
+    @param chunks: the text chunks to join
+    @type chunks: iterable of strings
+
+    @param flush_size: the number of characters to gather before encoding
+    them, the last block may be smaller
+    @type flush_size: int
+
+    @param encoding: the encoding of the blocks
+    @type encoding: string
+    """
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= flush_size:
+            yield u''.join(buffered).encode(encoding)
+            buffered = []
+            size = 0
+    if buffered:
+        yield u''.join(buffered).encode(encoding)
+
+
 def format_amount(amount, format="%f"):
     """Replace the thousands separator from '.' to ','
     """
@@ -263,9 +575,13 @@ class ImageInjector(object):
         """this will be called by genshi when rendering its template
         We only register our image data with a unique identifier
 
-        :param data: the image data, either as a base64 encoded string or
-        as the raw binary data directly from a file.read()
-        :type data: string or binary data
+        :param data: the image data, either as a base64 encoded string, as
+        the raw binary data directly from a file.read() or any bytes-like
+        object, as the path of the image file, or as a function without
+        argument returning the image data or a binary file object. Paths
+        and functions are only read when the document is written. Each
+        call with a function adds a new image to the document.
+        :type data: string, binary data, path or callable
 
         :param mime_type: the mime type of your image (ie: 'png', 'jpg')
         :type mime_type: string
@@ -299,12 +615,19 @@ class ImageInjector(object):
         if not data:
             return {}
 
-        if isb64:
-            # we need to decode the base64 data to obtain the raw data version
-            data = b64decode(data)
+        images = self.template.images
+        if callable(data):
+            # the content is unknown until it is loaded
+            identifier = images.new_identifier()
+            images.add_loader(identifier, data, mime_type)
 
-        identifier = hashlib.sha256(data).hexdigest()
-        self.template.set_image_data(identifier, data, mime_type=mime_type)
+        elif is_image_path(data, isb64):
+            # identify the file without reading it
+            identifier = images.add_file(data, mime_type)
+
+        else:
+            # the same image may be inserted many times
+            identifier = images.add_content(data, mime_type, isb64)
 
         attrs = {
             '{%s}href' % self.template.namespaces['xlink']: identifier,
@@ -338,10 +661,12 @@ class TextTemplate(object):
           http://genshi.edgewall.org/wiki/ApiDocs/genshi.template.text
 
         :type template: a string representing the full path name to a
-        template file.
+        template file, a binary file object or the template content as bytes.
 
-        :param outfile: the desired file name for the resulting text document
-        :type outfile: a string representing the full filename for output
+        :param outfile: the desired file name for the resulting text document,
+        or None to get the document back from render()
+        :type outfile: a string representing the full filename for output,
+        a binary file object or None
 
         :param encoding: By default the text encoding of the output will be
         UTF8. If you want another encoding you must specify it.
@@ -355,7 +680,11 @@ class TextTemplate(object):
         self.outputfilename = outfile
         self.encoding = encoding
 
-        content = codecs.open(template, 'rb', encoding='utf-8').read()
+        template = get_template_file(template)
+        if is_path(template):
+            content = codecs.open(template, 'rb', encoding='utf-8').read()
+        else:
+            content = template.read().decode('utf-8')
 
         if ignore_undefined_variables:
             self.template = GenshiTextTemplate(content, lookup='lenient')
@@ -367,33 +696,51 @@ class TextTemplate(object):
 
         :param data: a dictionnary containing your data (preferably
         a iterators)
-        :return: Nothing
+        :return: the document as bytes when no outfile was given, else
+        nothing
         """
-        with codecs.open(
-                self.outputfilename, 'wb+', encoding=self.encoding
-        ) as outfile:
+        if is_path(self.outputfilename):
+            with codecs.open(
+                    self.outputfilename, 'wb+', encoding=self.encoding
+            ) as outfile:
+
+                for kind, data, pos in self.template.generate(**data):
+                    outfile.write(data)
+            return
+
+        outfile = self.outputfilename
+        if outfile is None:
+            outfile = BytesIO()
+
+        for kind, data, pos in self.template.generate(**data):
+            outfile.write(data.encode(self.encoding))
 
-            for kind, data, pos in self.template.generate(**data):
-                outfile.write(data)
+        if self.outputfilename is None:
+            return outfile.getvalue()
 
 
 class Template(object):
     """The default template to be used to output ODF content."""
 
     templated_files = ['content.xml', 'styles.xml', 'META-INF/manifest.xml']
+    manifest_file = 'META-INF/manifest.xml'
 
     def __init__(self, template, outfile, ignore_undefined_variables=False,
-                 escape_false=False):
+                 escape_false=False, compression=None, flush_size=65536,
+                 image_spill_size=SPILL_SIZE, image_spill_dir=None,
+                 image_pool=None, engine='genshi', deterministic=False):
         """A template object exposes the API to render it to an OpenOffice
         document.
 
         @param template: a py3o template file. ie: a OpenDocument with the
         proper py3o markups
         @type template: a string representing the full path name to a py3o
-        template file.
+        template file, a binary file object or the template content as bytes.
 
-        @param outfile: the desired file name for the resulting ODT document
-        @type outfile: a string representing the full filename for output
+        @param outfile: the desired file name for the resulting ODT document,
+        or None to get the document back from render()
+        @type outfile: a string representing the full filename for output,
+        a binary file object or None
 
         @param ignore_undefined_variables: Not defined variables are replaced
         with an empty string during template rendering if True
@@ -402,10 +749,51 @@ class Template(object):
         @param escape false value: Values evaluated as False are replaced
         with an empty string during template rendering if True
         @type ignore_undefined_variables: boolean. Default is False
+
+        @param compression: how the members of the output document are
+        compressed. The default policy deflates the XML documents and copies
+        the other members of the template as they are.
+        @type compression: py3o.template.archive.CompressionPolicy
+
+        @param flush_size: the rendered documents are written to the output
+        by blocks of about this many characters, render_flow yields once per
+        block
+        @type flush_size: int. Default is 65536
+
+        @param image_spill_size: the images larger than this many bytes are
+        kept in a temporary directory instead of memory until the document
+        is written, None keeps them all in memory
+        @type image_spill_size: int. Default is 1 MiB
+
+        @param image_spill_dir: where to create the temporary directory of
+        the images
+        @type image_spill_dir: string. Default is the system temporary
+        directory
+
+        @param image_pool: a pool shared by the templates of the process to
+        identify the images given by content or path once, and keep one
+        copy of their content for all the renders
+        @type image_pool: py3o.template.images.ImagePool
+
+        @param engine: how the documents are rendered. 'fast' compiles them
+        into Python code, which renders them several times faster than
+        Genshi but only knows the py3o directives: the documents using other
+        Genshi features are still rendered by Genshi. A RenderBackend
+        instance renders them with another engine.
+        @type engine: string, 'genshi' or 'fast', or a
+        py3o.template.backends.RenderBackend. Default is 'genshi'
+
+        @param deterministic: render the same data into the same bytes: the
+        members added to the document get a fixed date, the images are
+        written in the order of their names and the images given by path
+        are named after their content
+        @type deterministic: boolean. Default is False
         """
+        self.backend = get_backend(engine)
+        self.deterministic = deterministic
         self.template = template
         self.outputfilename = outfile
-        self.infile = zipfile.ZipFile(self.template, 'r')
+        self.infile = zipfile.ZipFile(get_template_file(self.template), 'r')
 
         self.content_trees = [
             lxml.etree.parse(BytesIO(self.infile.read(filename)))
@@ -415,10 +803,25 @@ class Template(object):
 
         self.__prepare_namespaces()
 
-        self.images = {}
+        self.images = ImageStore(
+            image_spill_size, image_spill_dir, image_pool, deterministic
+        )
         self.output_streams = []
         self.ignore_undefined_variables = ignore_undefined_variables
         self.escape_false = escape_false
+        if compression is None:
+            compression = CompressionPolicy()
+        self.compression = compression
+        self.flush_size = flush_size
+        self.loop_iterations = 0
+        self.bytes_written = 0
+
+        # filled by prepare(), shared by every render of this template
+        self.prepared_templates = None
+        self.prepared_size = 0
+        self.static_images = []
+        self.directive_count = 0
+        self.directive_indexes = None
 
     def __prepare_namespaces(self):
         """create proper namespaces for our document
@@ -454,8 +857,7 @@ class Template(object):
         res = []
         text_nmspc = self.namespaces['text']
         table_nmspc = self.namespaces['table']
-        for e in get_all_python_expression(self.content_trees,
-                                           self.namespaces):
+        for e in self.__get_indexed('expressions'):
             if e.tag == "{%s}user-field-get" % text_nmspc:
                 py_expr = e.get("{%s}name" % text_nmspc)
                 # Remove the trailing 'py3o.'
@@ -512,9 +914,29 @@ class Template(object):
             for e in get_user_fields(self.content_trees[0], self.namespaces)
         ]
 
+    def __get_indexes(self):
+        """return the DirectiveIndex of each content tree, they are built
+        on first use
+        """
+        if self.directive_indexes is None:
+            self.directive_indexes = [
+                DirectiveIndex(content_tree, self.namespaces)
+                for content_tree in self.content_trees
+            ]
+        return self.directive_indexes
+
+    def __get_indexed(self, category):
+        """return the indexed nodes of a category in all content trees"""
+        return [
+            node
+            for index in self.__get_indexes()
+            for node in index.get(category)
+        ]
+
     def remove_soft_breaks(self):
-        for soft_break in get_soft_breaks(
-                self.content_trees[0], self.namespaces):
+        index = self.__get_indexes()[0]
+        for soft_break in index.get('soft_breaks'):
+            index.discard(soft_break)
             parent = soft_break.getparent()
             if soft_break.tail:
                 if parent.text:
@@ -577,51 +999,72 @@ class Template(object):
         return python_src
 
     @staticmethod
-    def find_image_frames(content_trees, namespaces):
+    def find_image_frames(content_trees, namespaces, frames=None):
         """find all frames that must be converted to images
+
+        frames can be given when they were already found in content_trees,
+        by a DirectiveIndex for instance
         """
         tags = []
 
-        for content_tree in content_trees:
-            for frame in get_image_frames(content_tree, namespaces):
-                py3o_statement = urllib.parse.unquote(
-                    frame.attrib['{%s}name' % namespaces['draw']]
-                )
-                # remove the "py3o.image("
-                py3o_base = py3o_statement[11:]
-                # remove the trailing ")"
-                py3o_base = py3o_base[:-1]
+        if frames is None:
+            frames = [
+                frame
+                for content_tree in content_trees
+                for frame in get_image_frames(content_tree, namespaces)
+            ]
+
+        for frame in frames:
+            py3o_statement = urllib.parse.unquote(
+                frame.attrib['{%s}name' % namespaces['draw']]
+            )
+            # remove the "py3o.image("
+            py3o_base = py3o_statement[11:]
+            # remove the trailing ")"
+            py3o_base = py3o_base[:-1]
 
-                tags.append((frame, py3o_base))
+            tags.append((frame, py3o_base))
 
         return tags
 
     @staticmethod
-    def find_instructions(content_trees, namespaces):
+    def find_instructions(content_trees, namespaces, links=None):
+        """find the starting py3o links and pair them with their closing
+        link
+
+        links can be given, in document order, when they were already found
+        in content_trees, by a DirectiveIndex for instance
+        """
 
         opened_starts = list()
         starting_tags = list()
         closing_tags = dict()
 
-        for content_tree in content_trees:
-            for link in get_instructions(content_tree, namespaces):
-                py3o_statement = urllib.parse.unquote(
-                    link.attrib['{%s}href' % namespaces['xlink']]
-                )
-                # remove the py3o://
-                py3o_base = py3o_statement[7:]
+        if links is None:
+            links = [
+                link
+                for content_tree in content_trees
+                for link in get_instructions(content_tree, namespaces)
+            ]
 
-                if not py3o_base.startswith("/"):
-                    if not py3o_base.startswith('function'):
-                        opened_starts.append(link)
-                    starting_tags.append((link, py3o_base))
+        for link in links:
+            py3o_statement = urllib.parse.unquote(
+                link.attrib['{%s}href' % namespaces['xlink']]
+            )
+            # remove the py3o://
+            py3o_base = py3o_statement[7:]
 
-                else:
-                    if not opened_starts:
-                        raise TemplateException(
-                            "No open instruction for %s" % py3o_base)
+            if not py3o_base.startswith("/"):
+                if not py3o_base.startswith('function'):
+                    opened_starts.append(link)
+                starting_tags.append((link, py3o_base))
 
-                    closing_tags[id(opened_starts.pop())] = link
+            else:
+                if not opened_starts:
+                    raise TemplateException(
+                        "No open instruction for %s" % py3o_base)
+
+                closing_tags[id(opened_starts.pop())] = link
 
         return starting_tags, closing_tags
 
@@ -668,6 +1111,7 @@ class Template(object):
         )
         # first child in the frame (ie: draw:text-box or equivalent), will be
         # removed and replaced by our new draw:image node we created
+        self.__discard_indexed(frame[0])
         frame.replace(frame[0], drawimage)
 
     def handle_link(self, link, py3o_base, closing_link):
@@ -747,8 +1191,10 @@ class Template(object):
             nsmap={'py': GENSHI_URI},
         )
 
+        self.__discard_indexed(link)
         link.getparent().remove(link)
         if closing_link is not None:
+            self.__discard_indexed(closing_link)
             closing_link.getparent().remove(closing_link)
 
         if instruction == 'content':
@@ -768,6 +1214,11 @@ class Template(object):
             new_span.append(genshi_node)
             opening_row.append(new_span)
         else:
+            # the boundaries leave the tree, they may come back as copies
+            self.__discard_indexed(opening_row)
+            if closing_row is not None:
+                self.__discard_indexed(closing_row)
+
             try:
                 move_siblings(
                     opening_row, closing_row, genshi_node,
@@ -780,32 +1231,50 @@ class Template(object):
                 raise TemplateException("Could not move siblings for '%s'" %
                                         py3o_base)
 
+            if keep_start_boundary:
+                self.__add_indexed(genshi_node[0])
+            if keep_end_boundary and closing_row is not None:
+                self.__add_indexed(genshi_node[-1])
+
+    def __discard_indexed(self, element):
+        """forget the indexed nodes of a subtree leaving its tree"""
+        root = element.getroottree().getroot()
+        for index, tree_root in zip(self.__get_indexes(), self.tree_roots):
+            if tree_root is root:
+                index.discard(element)
+
+    def __add_indexed(self, element):
+        """index the nodes of a subtree added to a tree"""
+        root = element.getroottree().getroot()
+        for index, tree_root in zip(self.__get_indexes(), self.tree_roots):
+            if tree_root is root:
+                index.add(element)
+
     def __prepare_userfield_decl(self):
         self.field_info = dict()
 
-        for content_tree in self.content_trees:
-            # here we gather the fields info in one pass to be able to avoid
-            # doing the same operation multiple times.
-            for userfield in get_user_fields(content_tree, self.namespaces):
+        # here we gather the fields info in one pass to be able to avoid
+        # doing the same operation multiple times.
+        for userfield in self.__get_indexed('user_fields'):
 
-                value = userfield.attrib[
-                    '{%s}name' % self.namespaces['text']
-                ][5:]
+            value = userfield.attrib[
+                '{%s}name' % self.namespaces['text']
+            ][5:]
 
-                value_type = userfield.attrib.get(
-                    '{%s}value-type' % self.namespaces['office'],
-                    'string'
-                )
+            value_type = userfield.attrib.get(
+                '{%s}value-type' % self.namespaces['office'],
+                'string'
+            )
 
-                value_datastyle_name = userfield.attrib.get(
-                    '{%s}data-style-name' % self.namespaces['style'],
-                )
+            value_datastyle_name = userfield.attrib.get(
+                '{%s}data-style-name' % self.namespaces['style'],
+            )
 
-                self.field_info[value] = {
-                    "name": value,
-                    "value_type": value_type,
-                    'value_datastyle_name': value_datastyle_name,
-                }
+            self.field_info[value] = {
+                "name": value,
+                "value_type": value_type,
+                'value_datastyle_name': value_datastyle_name,
+            }
 
     def __prepare_calc_formulas(self):
         """Prepare simple Genshi expressions used inside ODS cell formulas.
@@ -825,157 +1294,159 @@ class Template(object):
             ="${my_ODF_value}"
         """
 
-        field_expr = (
-            "//table:table-cell[regexp:match(@table:formula, '\${[^\${}]*}')]"
-        )
-
-        for content_tree in self.content_trees:
+        formula_attr = '{%s}formula' % self.namespaces['table']
 
-            for userfield in content_tree.xpath(
-                field_expr,
-                namespaces=self.namespaces
-            ):
-                parent = userfield.getparent()
-                formula_attr = '{%s}formula' % self.namespaces['table']
-                value = userfield.attrib[formula_attr]
-                userfield.attrib[formula_attr] = re.sub(
-                    r'\"?\${([\w.]*?)(?<!odf_value)}\"?',
-                    r'VALUE(${getattr(\1, "odf_value", "\"{}\"".format(\1))})',
-                    value
-                )
+        for userfield in self.__get_indexed('formulas'):
+            self.directive_count += 1
+            value = userfield.attrib[formula_attr]
+            userfield.attrib[formula_attr] = re.sub(
+                r'\"?\${([\w.]*?)(?<!odf_value)}\"?',
+                r'VALUE(${getattr(\1, "odf_value", "\"{}\"".format(\1))})',
+                value
+            )
 
     def __prepare_usertexts(self):
         """Replace user-type text fields that start with "py3o." with genshi
         instructions.
         """
 
-        field_expr = "//text:user-field-get[starts-with(@text:name, 'py3o.')]"
-
-        for content_tree in self.content_trees:
-
-            for userfield in content_tree.xpath(
-                field_expr,
-                namespaces=self.namespaces
-            ):
-                parent = userfield.getparent()
-                value = userfield.attrib[
-                    '{%s}name' % self.namespaces['text']
-                ][5:]
-                style_attr = '{%s}data-style-name' % self.namespaces['style']
-                style = userfield.attrib.get(style_attr)
-                if_attr = '{%s}if' % self.namespaces['py']
-
-                attribs = dict()
-                attribs['{%s}strip' % GENSHI_URI] = 'True'
-                attribs['{%s}content' % GENSHI_URI] = value
-
-                if self.escape_false:
-                    attribs[if_attr] = value
-
-                if style is not None:
-                    node_tag = '{%s}expression' % self.namespaces['text']
-
-                    formula = (
-                        "ooow:VALUE(\"${{getattr({val}, '{key}', '')}}\")"
-                    ).format(val=value, key='odf_value')
-                    vtype = "${{getattr({val}, '{key}', '{default}')}}".format(
-                        val=value, key='odf_type', default='string'
-                    )
-                    if_condition = "hasattr({val}, '{key}')".format(
-                        val=value, key='odf_value'
-                    )
+        for userfield in self.__get_indexed('user_texts'):
+            parent = userfield.getparent()
+            value = userfield.attrib[
+                '{%s}name' % self.namespaces['text']
+            ][5:]
+            style_attr = '{%s}data-style-name' % self.namespaces['style']
+            style = userfield.attrib.get(style_attr)
+            if_attr = '{%s}if' % self.namespaces['py']
+
+            attribs = dict()
+            attribs['{%s}strip' % GENSHI_URI] = 'True'
+            attribs['{%s}content' % GENSHI_URI] = value
+
+            if self.escape_false:
+                attribs[if_attr] = value
+
+            if style is not None:
+                node_tag = '{%s}expression' % self.namespaces['text']
+
+                formula = (
+                    "ooow:VALUE(\"${{getattr({val}, '{key}', '')}}\")"
+                ).format(val=value, key='odf_value')
+                vtype = "${{getattr({val}, '{key}', '{default}')}}".format(
+                    val=value, key='odf_type', default='string'
+                )
+                if_condition = "hasattr({val}, '{key}')".format(
+                    val=value, key='odf_value'
+                )
 
-                    formula_attribs = {
-                        '{%s}content' % GENSHI_URI: value,
-                        style_attr: style,
-                        if_attr: if_condition,
-                        '{%s}formula' % self.namespaces['text']: formula,
-                        '{%s}value-type' % self.namespaces['office']: vtype,
-                    }
-                    formula_node = lxml.etree.Element(
-                        node_tag, attrib=formula_attribs, nsmap=self.namespaces
-                    )
-                    userfield.addprevious(formula_node)
+                formula_attribs = {
+                    '{%s}content' % GENSHI_URI: value,
+                    style_attr: style,
+                    if_attr: if_condition,
+                    '{%s}formula' % self.namespaces['text']: formula,
+                    '{%s}value-type' % self.namespaces['office']: vtype,
+                }
+                formula_node = lxml.etree.Element(
+                    node_tag, attrib=formula_attribs, nsmap=self.namespaces
+                )
+                userfield.addprevious(formula_node)
 
-                    attribs[if_attr] = "not {cond}".format(cond=if_condition)
+                attribs[if_attr] = "not {cond}".format(cond=if_condition)
 
-                genshi_node = lxml.etree.Element(
-                    'span',
-                    attrib=attribs,
-                    nsmap={'py': GENSHI_URI}
-                )
+            genshi_node = lxml.etree.Element(
+                'span',
+                attrib=attribs,
+                nsmap={'py': GENSHI_URI}
+            )
 
-                if userfield.tail:
-                    genshi_node.tail = userfield.tail
+            if userfield.tail:
+                genshi_node.tail = userfield.tail
 
-                parent.replace(userfield, genshi_node)
+            self.__discard_indexed(userfield)
+            parent.replace(userfield, genshi_node)
+            self.directive_count += 1
 
     def __replace_image_links(self):
         """Replace links of placeholder images (the name of which starts with
         "py3o.staticimage.") to point to a file saved the "Pictures"
         directory of the archive.
-        """
 
-        image_expr = (
-            "//draw:frame[starts-with(@draw:name, 'py3o.staticimage')]"
-        )
+        The identifiers are remembered in self.static_images so that each
+        render can check the corresponding data has been provided.
+        """
 
-        for content_tree in self.content_trees:
+        for draw_frame in self.__get_indexed('static_images'):
+            # Find the identifier of the image
+            # (py3o.staticimage[identifier]).
+            image_id = draw_frame.attrib[
+                '{%s}name' % self.namespaces['draw']
+            ][5:]
+            self.static_images.append(image_id)
+            self.directive_count += 1
+
+            # Replace the xlink:href attribute of the image to point to
+            # ours.
+            image = draw_frame[0]
+            image.attrib[
+                '{%s}href' % self.namespaces['xlink']
+            ] = image_id
+
+    def __check_static_images(self):
+        """Make sure data was provided for every static image of the
+        template.
+        """
+        if self.ignore_undefined_variables:
+            return
 
-            # Find draw:frame tags.
-            for draw_frame in content_tree.xpath(
-                image_expr,
-                namespaces=self.namespaces
-            ):
-                # Find the identifier of the image
-                # (py3o.staticimage[identifier]).
-                image_id = draw_frame.attrib[
-                    '{%s}name' % self.namespaces['draw']
-                ][5:]
-                if image_id not in self.images:
-                    if not self.ignore_undefined_variables:
-                        raise TemplateException(
-                            "Can't find data for the image named 'py3o.%s'; "
-                            "make sure it has been added with the "
-                            "set_image_path or set_image_data methods."
-                            % image_id
-                        )
-
-                # Replace the xlink:href attribute of the image to point to
-                # ours.
-                image = draw_frame[0]
-                image.attrib[
-                    '{%s}href' % self.namespaces['xlink']
-                ] = image_id
+        for image_id in self.static_images:
+            if image_id not in self.images:
+                raise TemplateException(
+                    "Can't find data for the image named 'py3o.%s'; "
+                    "make sure it has been added with the "
+                    "set_image_path or set_image_data methods."
+                    % image_id
+                )
 
     def __add_images_to_manifest(self):
-        """Add entries for py3o images into the manifest file."""
+        """Add entries for py3o images into the manifest file.
 
-        xpath_expr = "//manifest:manifest[1]"
+        @returns: the serialized manifest
+        """
+        manifest_tree = self.content_trees[
+            self.templated_files.index(self.manifest_file)
+        ]
 
-        for content_tree in self.content_trees:
+        # work on a copy: the prepared tree is shared between renders
+        manifest = deepcopy(manifest_tree.getroot())
 
-            # Find manifest:manifest tags.
-            manifest_e = content_tree.xpath(
-                xpath_expr,
-                namespaces=self.namespaces
+        for identifier, image in self.__get_images():
+            mime = image.mime_type
+            attribs = {
+                '{%s}full-path' % self.namespaces['manifest']: identifier,
+                '{%s}media-type' % self.namespaces['manifest']: mime or ''
+            }
+            # Add a manifest:file-entry tag.
+            lxml.etree.SubElement(
+                manifest,
+                '{%s}file-entry' % self.namespaces['manifest'],
+                attrib=attribs
             )
-            if not manifest_e:
-                continue
+        return lxml.etree.tostring(manifest)
 
-            for identifier in self.images.keys():
-                mime = self.images.get(identifier).get('mime_type', None)
-                attribs = {
-                    '{%s}full-path' % self.namespaces['manifest']: identifier,
-                    '{%s}media-type' % self.namespaces['manifest']: mime or ''
-                }
-                # Add a manifest:file-entry tag.
-                lxml.etree.SubElement(
-                    manifest_e[0],
-                    '{%s}file-entry' % self.namespaces['manifest'],
-                    attrib=attribs
-                )
-            return manifest_e[0]
+    def __get_images(self):
+        """return the (identifier, image) pairs of the images to write, in
+        the order of their identifiers for deterministic renders
+        """
+        if self.deterministic:
+            return sorted(self.images.items(), key=lambda item: item[0])
+        return self.images.items()
+
+    def __get_image_info(self, identifier, image):
+        """return the ZipInfo to write an image with"""
+        return self.compression.get_image_info(
+            identifier, image.mime_type,
+            date_time=self.deterministic and FIXED_DATE_TIME or None,
+        )
 
     def add_base_data_to_template(self):
         return {
@@ -985,11 +1456,16 @@ class Template(object):
             "__py3o_image": ImageInjector(self),
         }
 
-    def render_tree(self, data):
-        """prepare the flows without saving to file
-        this method has been decoupled from render_flow to allow better
-        unit testing
+    def prepare(self):
+        """transform the py3o template into Genshi templates
+
+        The content trees are modified in place, this is why the work is
+        only done once: calling this method again is a no-op. The resulting
+        Genshi templates are kept in self.prepared_templates and can be
+        rendered any number of times by render_tree.
         """
+        if self.prepared_templates is not None:
+            return
 
         # Soft page breaks are hints for applications for rendering a page
         # break. Soft page breaks in for loops may compromise the paragraph
@@ -1002,7 +1478,8 @@ class Template(object):
         # Genshi template.
         starting_tags, closing_tags = self.find_instructions(
             self.content_trees,
-            self.namespaces
+            self.namespaces,
+            links=self.__get_indexed('instructions'),
         )
         parent2tag = {}  # key = parent ; value = tag
         for tag in starting_tags:
@@ -1015,8 +1492,8 @@ class Template(object):
                 )
             else:
                 parent2tag[parent] = tag
-        parents = parent2tag.keys()
 
+        self.directive_count = len(starting_tags) + len(closing_tags)
         for link, py3o_base in starting_tags:
             self.handle_link(
                 link,
@@ -1026,9 +1503,14 @@ class Template(object):
 
         # handle all draw links that will need to receive image content
         # in their childrens
-        tags = self.find_image_frames(self.content_trees, self.namespaces)
+        tags = self.find_image_frames(
+            self.content_trees,
+            self.namespaces,
+            frames=self.__get_indexed('image_frames'),
+        )
         # draw frames with special names will be auto injected with image
         # injectors
+        self.directive_count += len(tags)
         for frame, py3o_base in tags:
             self.handle_draw_frame(
                 frame,
@@ -1041,44 +1523,159 @@ class Template(object):
 
         self.__replace_image_links()
 
-        # Add base functions/module access inside the template.
-        # Also allow users to add their own data
-        new_data = self.add_base_data_to_template()
+        self.__compile_trees()
 
-        for fnum, content_tree in enumerate(self.content_trees):
-            content = lxml.etree.tostring(content_tree.getroot())
-            if self.ignore_undefined_variables:
-                template = MarkupTemplate(content, lookup='lenient')
-            else:
-                template = MarkupTemplate(content)
+    def load_prepared(self, documents, static_images):
+        """use documents transformed by an earlier call to prepare instead of
+        transforming the template again
+
+        @param documents: the serialized prepared content trees, in the
+        order of templated_files
+        @type documents: list of bytes
+
+        @param static_images: the identifiers of the static images used by
+        the template
+        @type static_images: list of strings
+        """
+        self.content_trees = [
+            lxml.etree.parse(BytesIO(document)) for document in documents
+        ]
+        self.tree_roots = [tree.getroot() for tree in self.content_trees]
+        self.__prepare_namespaces()
+        self.directive_indexes = None
 
-            # then we need to render the genshi template itself by
-            # providing the data to genshi
+        self.static_images = list(static_images)
+        self.__compile_trees()
 
-            template_dict = {}
-            template_dict.update(data.items())
-            template_dict.update(new_data.items())
+    def __compile_trees(self):
+        """compile the prepared content trees with the render backend
 
-            self.output_streams.append(
-                (
-                    self.templated_files[fnum],
-                    template.generate(**template_dict)
+        Files without any directive and the manifest get None instead of a
+        compiled document, they are not rendered. The files the backend does
+        not support are compiled by Genshi.
+        """
+        prepared_templates = []
+        self.prepared_size = 0
+        lookup = self.ignore_undefined_variables and 'lenient' or 'strict'
+        for fnum, content_tree in enumerate(self.content_trees):
+            # the manifest is never rendered, see __save_output
+            if self.templated_files[fnum] == self.manifest_file or (
+                not has_directives(content_tree, self.namespaces)
+            ):
+                prepared_templates.append((self.templated_files[fnum], None))
+                continue
+
+            # compile the document straight from the tree, the size of the
+            # source document is a good estimation of the prepared one
+            fname = self.templated_files[fnum]
+            self.prepared_size += self.infile.getinfo(fname).file_size
+            backend = self.backend
+            events = wrap_loops(iter_genshi_events(content_tree.getroot()))
+            try:
+                document = backend.compile(
+                    events, self.namespaces, lookup=lookup,
+                    flush_size=self.flush_size, filename=fname,
                 )
+            except UnsupportedTemplate as e:
+                log.debug("%s is rendered by Genshi: %s", fname, e)
+                backend = DEFAULT_BACKEND
+                document = backend.compile(
+                    wrap_loops(iter_genshi_events(content_tree.getroot())),
+                    self.namespaces, lookup=lookup,
+                    flush_size=self.flush_size, filename=fname,
+                )
+
+            prepared_templates.append(
+                (fname, PreparedDocument(backend, document))
             )
 
-    def render_flow(self, data):
+        self.prepared_templates = prepared_templates
+
+    def render_tree(self, data, count_loops=False):
+        """prepare the flows without saving to file
+        this method has been decoupled from render_flow to allow better
+        unit testing
+
+        @param count_loops: count the py:for iterations done by the flows
+        in self.loop_iterations
+        @type count_loops: boolean. Default is False
+        """
+        self.prepare()
+        self.__check_static_images()
+
+        # Add base functions/module access inside the template.
+        # Also allow users to add their own data
+        new_data = self.add_base_data_to_template()
+
+        template_dict = {}
+        template_dict.update(data.items())
+        template_dict.update(new_data.items())
+
+        # every py:for iterates through __py3o_loop, see wrap_loops
+        self.loop_iterations = 0
+        if count_loops:
+            template_dict['__py3o_loop'] = self.__count_loop
+        else:
+            template_dict['__py3o_loop'] = lambda iterable: iterable
+
+        # then we need to render the prepared documents by providing the
+        # data to their backend
+        self.output_streams = [
+            (
+                fname,
+                prepared.backend.generate(prepared.document, template_dict)
+                if prepared is not None else None
+            )
+            for fname, prepared in self.prepared_templates
+        ]
+
+    def __count_loop(self, iterable):
+        """the __py3o_loop of the template data when loops are counted"""
+        for item in iterable:
+            yield item
+            # the loop body was rendered when the next item is asked for
+            self.loop_iterations += 1
+
+    def render_flow(self, data, progress=False):
         """render the OpenDocument with the user data
 
         @param data: the input stream of user data. This should be a dictionary
         mapping, keys being the values accessible to your report.
         @type data: dictionary
+
+        @param progress: yield RenderProgress records instead of True values
+        @type progress: boolean. Default is False
         """
 
-        self.render_tree(data)
+        if self.outputfilename is None:
+            raise TemplateException(
+                "render_flow needs an outfile, use render to get the "
+                "document as bytes"
+            )
 
-        # then reconstruct a new ODT document with the generated content
-        for status in self.__save_output():
-            yield status
+        start = time.time()
+        try:
+            self.render_tree(data, count_loops=progress)
+            if progress:
+                yield self.__get_progress('prepare', None, start)
+
+            # then reconstruct a new ODT document with the generated content
+            for phase, member in self.__save_output(self.outputfilename):
+                if progress:
+                    yield self.__get_progress(phase, member, start)
+                else:
+                    yield True
+        finally:
+            # the rendered template is in a reference cycle through its
+            # data, do not wait for the garbage collector to remove the
+            # spilled images
+            self.images.close()
+
+    def __get_progress(self, phase, member, start):
+        return RenderProgress(
+            phase, member, self.bytes_written, time.time() - start,
+            self.loop_iterations,
+        )
 
     def render(self, data):
         """render the OpenDocument with the user data
@@ -1086,11 +1683,33 @@ class Template(object):
         @param data: the input stream of userdata. This should be a dictionary
         mapping, keys being the values accessible to your report.
         @type data: dictionary
+
+        @returns: the document as bytes when the template has no outfile,
+        else None
         """
-        for status in self.render_flow(data):
+        if self.outputfilename is not None:
+            flow = self.render_flow(data)
+        else:
+            outfile = BytesIO()
+            flow = self.__render_to(outfile, data)
+
+        for status in flow:
             if not status:  # pragma: no cover
                 raise TemplateException("unknown template error")
 
+        if self.outputfilename is None:
+            return outfile.getvalue()
+
+    def __render_to(self, outfile, data):
+        """render the document into a binary file object, see render_flow"""
+        try:
+            self.render_tree(data)
+            for status in self.__save_output(outfile):
+                yield status
+        finally:
+            # see render_flow
+            self.images.close()
+
     def set_image_path(self, identifier, path):
         """Set data for an image mentioned in the template.
 
@@ -1098,13 +1717,12 @@ class Template(object):
         template by setting "py3o.[identifier]" as the name of that image.
         @type identifier: string
 
-        @param path: Image path on the file system
+        @param path: Image path on the file system, the file is read when
+        the document is written
         @type path: string
         """
 
-        f = open(path, 'rb')
-        self.set_image_data(identifier, f.read())
-        f.close()
+        self.images.add_path(identifier, path)
 
     def set_image_data(self, identifier, data, mime_type=None):
         """Set data for an image mentioned in the template.
@@ -1118,63 +1736,319 @@ class Template(object):
         @type data: binary
         """
 
-        self.images[identifier] = {
-            'data': data,
-            'mime_type': mime_type,
-        }
+        self.images.add(identifier, data, mime_type)
 
-    def __save_output(self):
-        """Saves the output into a native OOo document format.
+    def __deflate_unchanged(self, executor):
+        """start deflating the members of the output that do not depend
+        on the rendering: the members copied from the template that are
+        compressed again and the images
+
+        @returns: a dictionary of futures by member name, see
+        CompressionPolicy.deflate_later
         """
-        out = zipfile.ZipFile(self.outputfilename, 'w', allowZip64=True)
+        deflated = {}
+        rendered = set(
+            fname for fname, stream in self.output_streams
+            if stream is not None
+        )
+        if self.images:
+            rendered.add(self.manifest_file)
 
         for info_zip in self.infile.infolist():
+            if info_zip.filename in rendered:
+                continue
+            zinfo = self.compression.get_copy_info(info_zip)
+            if zinfo is not None and (
+                zinfo.compress_type == zipfile.ZIP_DEFLATED
+            ):
+                deflated[info_zip.filename] = self.compression.deflate_later(
+                    executor,
+                    partial(self.infile.read, info_zip.filename)
+                )
 
-            if info_zip.filename in self.templated_files:
-                # get a temp file
-                streamout = open(get_secure_filename(), "w+b")
+        for identifier, image in self.images.items():
+            zinfo = self.__get_image_info(identifier, image)
+            # the images out of memory are streamed by the rendering
+            # thread, their deflated data would pile up in memory
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED and (
+                image.in_memory
+            ):
+                deflated[identifier] = self.compression.deflate_later(
+                    executor, image.data
+                )
+        return deflated
 
-                # Template file - we have edited these.
-                if "manifest.xml" in info_zip.filename:
-                    fname, _ = self.output_streams[
-                        self.templated_files.index(info_zip.filename)
-                    ]
-                    manifest_e = self.__add_images_to_manifest()
-                    streamout.write(lxml.etree.tostring(manifest_e))
+    def __save_output(self, outfile):
+        """Saves the output into a native OOo document format.
 
-                else:
-                    fname, output_stream = self.output_streams[
-                        self.templated_files.index(info_zip.filename)
-                    ]
+        @param outfile: where to write the document
+        @type outfile: a file name or a binary file object
 
-                    transformer = get_list_transformer(self.namespaces)
-                    nstream = output_stream | transformer
+        @returns: a generator of (phase, member) tuples, see RenderProgress
+        """
+        out = zipfile.ZipFile(outfile, 'w', allowZip64=True)
+        self.bytes_written = 0
 
-                    # write the whole stream to it
-                    for chunk in nstream.serialize():
-                        streamout.write(chunk.encode('utf-8'))
-                        yield True
+        # with a pool of threads, deflate the members that do not depend on
+        # the data while the documents are rendered
+        executor = self.compression.get_executor()
+        deflated = {}
+        if executor is not None:
+            deflated = self.__deflate_unchanged(executor)
 
-                    streamout.seek(0)
+        for info_zip in self.infile.infolist():
+
+            if info_zip.filename in self.templated_files:
+                fname, output_stream = self.output_streams[
+                    self.templated_files.index(info_zip.filename)
+                ]
+            else:
+                output_stream = None
+
+            if info_zip.filename == self.manifest_file and self.images:
+                # declare our images, the manifest needs no other change
+                manifest = self.__add_images_to_manifest()
+                out.writestr(
+                    self.compression.get_info(self.manifest_file, info_zip),
+                    manifest
+                )
+                self.bytes_written += len(manifest)
+                yield 'zip', self.manifest_file
+
+            elif output_stream is not None:
+                # Template file - we have edited these.
+                backend = self.prepared_templates[
+                    self.templated_files.index(info_zip.filename)
+                ][1].backend
+                chunks = backend.serialize(output_stream)
+                zinfo = self.compression.get_info(fname, info_zip)
+                blocks = iter_encoded(chunks, self.flush_size)
+                yield 'generate', fname
+
+                if executor is not None and (
+                    zinfo.compress_type == zipfile.ZIP_DEFLATED
+                ):
+                    # deflate the blocks on the pool while the next ones
+                    # are rendered
+                    for size in write_deflated_blocks(
+                        out, zinfo, blocks, executor,
+                        self.compression.deflate_level
+                    ):
+                        self.bytes_written += size
+                        yield 'serialize', fname
+                    continue
+
+                if ZIP_STREAMING:
+                    # write the serialized stream straight into the archive,
+                    # its size is unknown and may need ZIP64 extensions
+                    with out.open(zinfo, 'w', force_zip64=True) as streamout:
+                        for block in blocks:
+                            streamout.write(block)
+                            self.bytes_written += len(block)
+                            yield 'serialize', fname
+                    continue
+
+                # zipfile cannot write members incrementally before
+                # Python 3.6, go through a temp file
+                streamout = open(get_secure_filename(), "w+b")
+
+                # write the whole stream to it
+                for block in blocks:
+                    streamout.write(block)
+                    self.bytes_written += len(block)
+                    yield 'serialize', fname
 
                 # close the temp file to flush all data and make sure we get
                 # it back when writing to the zip archive.
                 streamout.close()
 
-                # write the full file to archive
-                out.write(streamout.name, fname)
+                # write the full file to archive, with the date of the
+                # template member
+                timestamp = time.mktime(zinfo.date_time + (0, 0, -1))
+                os.utime(streamout.name, (timestamp, timestamp))
+                out.write(
+                    streamout.name, fname, compress_type=zinfo.compress_type
+                )
 
                 # remove temp file
                 os.unlink(streamout.name)
 
             else:
-                # Copy other files straight from the source archive.
-                out.writestr(info_zip, self.infile.read(info_zip.filename))
+                # Copy other files, and templated files without directives,
+                # straight from the source archive.
+                self.compression.copy_member(
+                    self.infile, out, info_zip,
+                    deflated.get(info_zip.filename)
+                )
+                self.bytes_written += info_zip.file_size
+                yield 'zip', info_zip.filename
 
         # Save images in the "Pictures" sub-directory of the archive.
-        for identifier, im_struct in self.images.items():
-            out.writestr(identifier, im_struct.get('data'))
+        for identifier, image in self.__get_images():
+            zinfo = self.__get_image_info(identifier, image)
+            if identifier in deflated:
+                write_deflated_member(
+                    out, zinfo, deflated[identifier].result()
+                )
+            elif image.in_memory:
+                out.writestr(zinfo, image.data)
+            else:
+                # stream the image from its file or loader
+                zinfo.file_size = image.size or 0
+                source = image.open()
+                try:
+                    write_file_member(out, zinfo, source)
+                finally:
+                    source.close()
+            self.bytes_written += zinfo.file_size
+            yield 'zip', identifier
 
         # close the zipfile before leaving
         out.close()
-        yield True
+        yield 'zip', None
+
+
+class CompiledTemplate(object):
+    """A py3o template that is prepared once and rendered many times.
+
+    The ODF archive is opened and the py3o links, user fields and image
+    frames are transformed into Genshi templates only once. Each render then
+    gets its own light copy of the prepared template to hold its images and
+    output streams.
+    """
+
+    def __init__(self, template, ignore_undefined_variables=False,
+                 escape_false=False, prepared=None, compression=None,
+                 flush_size=65536, image_spill_size=SPILL_SIZE,
+                 image_spill_dir=None, image_pool=None, engine='genshi',
+                 deterministic=False):
+        """
+        @param template: a py3o template file. ie: a OpenDocument with the
+        proper py3o markups
+        @type template: a string representing the full path name to a py3o
+        template file, a binary file object or the template content as bytes.
+
+        @param ignore_undefined_variables: Not defined variables are replaced
+        with an empty string during template rendering if True
+        @type ignore_undefined_variables: boolean. Default is False
+
+        @param escape_false: Values evaluated as False are replaced
+        with an empty string during template rendering if True
+        @type escape_false: boolean. Default is False
+
+        @param prepared: the result of dump_prepared() on the same template
+        with the same options. When given, the py3o instructions are not
+        transformed again.
+        @type prepared: a (documents, static_images) tuple
+
+        @param compression: how the members of the rendered documents are
+        compressed
+        @type compression: py3o.template.archive.CompressionPolicy
+
+        @param flush_size: the size of the blocks the rendered documents are
+        written by
+        @type flush_size: int. Default is 65536
+
+        @param image_spill_size: the size from which the images of a render
+        are kept in a temporary directory instead of memory
+        @type image_spill_size: int. Default is 1 MiB
+
+        @param image_spill_dir: where to create the temporary directories of
+        the images
+        @type image_spill_dir: string
+
+        @param image_pool: identifies the images of the renders and shares
+        their content between them
+        @type image_pool: py3o.template.images.ImagePool
+
+        @param engine: how the documents are rendered, see Template
+        @type engine: string, 'genshi' or 'fast', or a
+        py3o.template.backends.RenderBackend. Default is 'genshi'
+
+        @param deterministic: render the same data into the same bytes, see
+        Template
+        @type deterministic: boolean. Default is False
+        """
+        self.template = Template(
+            template, None,
+            ignore_undefined_variables=ignore_undefined_variables,
+            escape_false=escape_false,
+            compression=compression,
+            flush_size=flush_size,
+            image_spill_size=image_spill_size,
+            image_spill_dir=image_spill_dir,
+            image_pool=image_pool,
+            engine=engine,
+            deterministic=deterministic,
+        )
+        if prepared is None:
+            self.template.prepare()
+        else:
+            self.template.load_prepared(*prepared)
+
+    @property
+    def namespaces(self):
+        return self.template.namespaces
+
+    @property
+    def directive_count(self):
+        """the number of py3o instructions found while preparing the
+        template, 0 when it was loaded from its prepared form
+        """
+        return self.template.directive_count
+
+    @property
+    def size(self):
+        """an estimation of the memory used by this template in bytes: the
+        compressed source archive plus the prepared XML documents
+        """
+        return self.template.prepared_size + sum(
+            info.compress_size for info in self.template.infile.infolist()
+        )
+
+    def dump_prepared(self):
+        """return the prepared form of the template, suitable to be stored
+        and given back later as the prepared argument of the constructor
+
+        @returns: a (documents, static_images) tuple where documents is the
+        list of the serialized prepared XML documents
+        """
+        documents = [
+            lxml.etree.tostring(tree.getroot())
+            for tree in self.template.content_trees
+        ]
+        return documents, list(self.template.static_images)
+
+    def new_render(self, outfile=None):
+        """return a Template bound to outfile that shares our prepared
+        Genshi templates. Use it when you need to call set_image_path or
+        set_image_data before rendering.
+
+        @param outfile: the desired file name for the resulting ODF document,
+        or None to get the document back from render()
+        @type outfile: a string representing the full filename for output,
+        a binary file object or None
+
+        @returns: a py3o.template.Template instance ready to be rendered
+        """
+        render = copy(self.template)
+        render.outputfilename = outfile
+        render.images = self.template.images.new()
+        render.output_streams = []
+        return render
+
+    def render(self, data, outfile=None):
+        """render the prepared template with the user data
+
+        @param data: the input stream of userdata. This should be a dictionary
+        mapping, keys being the values accessible to your report.
+        @type data: dictionary
+
+        @param outfile: the desired file name for the resulting ODF document,
+        or None to get the document back as bytes
+        @type outfile: a string representing the full filename for output,
+        a binary file object or None
+
+        @returns: the document as bytes when outfile is None, else None
+        """
+        return self.new_render(outfile).render(data)
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+"""The py3o-compile command: prepare a directory of templates ahead of time.
+
+The prepared templates are written in a directory that can then be used as
+a :class:`DiskTemplateCache` by the rendering processes, along with a
+manifest.json file describing what was prepared and how long it took.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import genshi
+
+from py3o.template.cache import (
+    DiskTemplateCache,
+    get_fingerprint,
+    get_py3o_version,
+)
+from py3o.template.main import CompiledTemplate
+
+TEMPLATE_EXTENSIONS = ('.odt', '.ods')
+MANIFEST_NAME = 'manifest.json'
+
+
+def find_templates(directory):
+    """return the sorted paths of all the templates found in directory"""
+    templates = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(TEMPLATE_EXTENSIONS):
+                templates.append(os.path.join(root, name))
+    return sorted(templates)
+
+
+def compile_template(args):
+    """prepare one template and store it in the output directory
+
+    @param args: a (path, output, options) tuple, packed to be usable
+    with Pool.imap_unordered
+    @returns: a dictionary describing the result
+    """
+    path, output, options = args
+    cache = DiskTemplateCache(output)
+    result = {'template': path}
+
+    try:
+        fingerprint, source = get_fingerprint(path)
+        start = time.time()
+        compiled = CompiledTemplate(
+            source,
+            ignore_undefined_variables=options[0],
+            escape_false=options[1],
+        )
+        result['prepare_time'] = time.time() - start
+
+        artifact = cache.get_path(fingerprint, options)
+        cache.store(artifact, fingerprint, options, compiled)
+
+    except Exception as e:
+        # a corrupt archive or a malformed document must not stop the
+        # other templates from being prepared
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+        return result
+
+    result.update({
+        'fingerprint': fingerprint,
+        'artifact': os.path.basename(artifact),
+        'directives': compiled.directive_count,
+        'size': compiled.size,
+    })
+    return result
+
+
+def compile_directory(directory, output, jobs=None, options=(False, False)):
+    """prepare all the templates of directory in parallel and write the
+    manifest in output
+
+    @returns: the list of results, in the order of the template paths
+    """
+    tasks = [
+        (path, output, options) for path in find_templates(directory)
+    ]
+    # create it before the workers race to do it
+    DiskTemplateCache(output)
+
+    if jobs == 1 or len(tasks) < 2:
+        results = [compile_template(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(compile_template, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    for result in results:
+        result['template'] = os.path.relpath(result['template'], directory)
+
+    manifest = {
+        'py3o': get_py3o_version(),
+        'genshi': genshi.__version__,
+        'options': {
+            'ignore_undefined_variables': options[0],
+            'escape_false': options[1],
+        },
+        'templates': results,
+    }
+    with open(os.path.join(output, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='py3o-compile',
+        description="Prepare py3o templates ahead of time.",
+    )
+    parser.add_argument(
+        'directory', help="the directory containing .odt/.ods templates"
+    )
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help="the directory receiving the prepared templates, to be used "
+             "as a DiskTemplateCache directory",
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        '--ignore-undefined-variables', action='store_true',
+        help="prepare the templates for lenient rendering",
+    )
+    parser.add_argument(
+        '--escape-false', action='store_true',
+        help="prepare the templates to render false values as empty strings",
+    )
+    args = parser.parse_args(argv)
+
+    results = compile_directory(
+        args.directory, args.output, jobs=args.jobs,
+        options=(args.ignore_undefined_variables, args.escape_false),
+    )
+
+    errors = 0
+    for result in sorted(
+        results, key=lambda r: r.get('prepare_time', 0), reverse=True
+    ):
+        if 'error' in result:
+            errors += 1
+            print("%s: error: %s" % (result['template'], result['error']),
+                  file=sys.stderr)
+        else:
+            print("%9.1f ms %6d directives  %s" % (
+                result['prepare_time'] * 1000,
+                result['directives'],
+                result['template'],
+            ))
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
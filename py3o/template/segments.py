@@ -0,0 +1,167 @@
+# -*- encoding: utf-8 -*-
+"""Pre-serialized static parts of the prepared documents.
+
+Most of a document does not depend on the data: styles, headers and the
+text around the py3o instructions. Genshi still walks and serializes every
+node of these parts at each render. Before a prepared document is given to
+Genshi, each largest subtree without directive nor expression is serialized
+once, and replaced by an expression giving its markup back.
+"""
+from genshi.core import Markup, escape
+from genshi.core import START, END, TEXT, START_NS, END_NS
+from genshi.template.base import EXPR, TemplateSyntaxError
+from genshi.template.eval import Expression
+from genshi.template.interpolation import interpolate
+
+from py3o.template.fast import (
+    DIRECTIVE_NAMESPACE, XML_SPACE, NamespaceScope, UnsupportedTemplate,
+    normalize_space,
+)
+
+
+class StaticMarkup(Expression):
+    """an expression evaluating to a pre-serialized part of a document"""
+
+    def __init__(self, markup):
+        self.source = '<static markup>'
+        self.code = None
+        self.ast = None
+        self.markup = markup
+
+    def evaluate(self, data):
+        return self.markup
+
+
+def get_static_text(text):
+    """return the text of a template string, None when it holds an
+    expression"""
+    if not text or '$' not in text:
+        return text
+    try:
+        parts = list(interpolate(text))
+    except TemplateSyntaxError:
+        return None
+    if len(parts) == 1 and parts[0][0] is TEXT:
+        return parts[0][1]
+    return None
+
+
+def is_static_start(tag, attrs, list_tag):
+    """tell if a start tag is the same at each render"""
+    if tag.namespace == DIRECTIVE_NAMESPACE or tag == list_tag:
+        # the lists get a new xml:id at each render
+        return False
+    for name, value in attrs:
+        if name.namespace == DIRECTIVE_NAMESPACE or name == XML_SPACE:
+            return False
+        if get_static_text(value) is None:
+            return False
+    return True
+
+
+def find_static_trees(events, list_tag=None):
+    """return the index of the end of each static element, by the index of
+    its start
+    """
+    ends = {}
+    # the open elements: the index of their start, whether they are static
+    # so far and whether their whitespace is kept
+    stack = []
+    declared = False
+    for index, (kind, data, pos) in enumerate(events):
+        if kind is START:
+            tag, attrs = data
+            preserve = XML_SPACE in attrs or bool(stack and stack[-1][2])
+            static = not declared and not preserve and is_static_start(
+                tag, attrs, list_tag
+            )
+            stack.append([index, static, preserve])
+            declared = False
+        elif kind is END:
+            start, static, preserve = stack.pop()
+            if static:
+                ends[start] = index
+            elif stack:
+                stack[-1][1] = False
+        elif kind is START_NS:
+            if data[1] != DIRECTIVE_NAMESPACE:
+                declared = True
+        elif kind is END_NS:
+            pass
+        elif stack and (kind is not TEXT or get_static_text(data) is None):
+            stack[-1][1] = False
+    return ends
+
+
+def serialize_static(events, scope):
+    """serialize static events like the XMLSerializer of Genshi does"""
+    out = []
+    texts = []
+    pending = None
+    for kind, data, pos in events:
+        if kind is START:
+            if pending is not None:
+                out.append(pending + '>')
+            elif texts:
+                out.append(normalize_space(u''.join(texts)))
+                texts = []
+            tag, attrs = data
+            pending = u'<' + scope.get_name(tag) + u''.join(
+                u' %s="%s"' % (
+                    scope.get_name(name), escape(get_static_text(value))
+                )
+                for name, value in attrs
+            )
+        elif kind is END:
+            if pending is not None:
+                out.append(pending + '/>')
+                pending = None
+            else:
+                if texts:
+                    out.append(normalize_space(u''.join(texts)))
+                    texts = []
+                out.append(u'</%s>' % scope.get_name(data))
+        elif kind is TEXT:
+            if pending is not None:
+                out.append(pending + '>')
+                pending = None
+            texts.append(escape(get_static_text(data), quotes=False))
+    return Markup(u''.join(out))
+
+
+def iter_static_segments(events, list_tag=None):
+    """replace the static elements of a stream by their serialized markup
+
+    @param events: the markup events of a prepared document
+    @type events: iterable
+
+    @param list_tag: the lists, which are never static
+    @type list_tag: genshi.core.QName
+
+    @returns: the events, each largest static element being replaced by an
+    EXPR event giving its markup back
+    """
+    events = list(events)
+    ends = find_static_trees(events, list_tag)
+    scope = NamespaceScope()
+    index = 0
+    while index < len(events):
+        kind, data, pos = events[index]
+        end = ends.get(index)
+        if end is not None:
+            try:
+                markup = serialize_static(events[index:end + 1], scope)
+            except UnsupportedTemplate:
+                # an undeclared namespace, Genshi makes up a prefix for it
+                markup = None
+            if markup is not None and normalize_space(markup) == markup:
+                yield EXPR, StaticMarkup(markup), pos
+                index = end + 1
+                continue
+
+        if kind is START_NS and data[1] != DIRECTIVE_NAMESPACE:
+            scope.push(*data)
+        elif kind is END_NS:
+            scope.pop(data)
+        yield kind, data, pos
+        index += 1
@@ -0,0 +1,262 @@
+# -*- encoding: utf-8 -*-
+import struct
+import unittest
+import zipfile
+from io import BytesIO
+
+import pkg_resources
+import six
+
+from py3o.template import Template, CompressionPolicy
+from py3o.template.archive import (
+    PASSTHROUGH_RECOMPRESS, ZIP_STREAMING, copy_member, read_raw_member,
+    write_deflated_blocks,
+)
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
+if six.PY3:
+    # noinspection PyUnresolvedReferences
+    from unittest.mock import patch
+elif six.PY2:
+    # noinspection PyUnresolvedReferences
+    from mock import patch
+
+
+def template_path(name):
+    return pkg_resources.resource_filename(
+        'py3o.template', 'tests/templates/%s' % name
+    )
+
+
+def has_zip64_header(data, info):
+    """tell if the local header of a member has a ZIP64 extra field"""
+    name_size, extra_size = struct.unpack(
+        '<HH', data[info.header_offset + 26:info.header_offset + 30]
+    )
+    start = info.header_offset + 30 + name_size
+    extra = data[start:start + extra_size]
+    while extra:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id == 1:
+            return True
+        extra = extra[4 + size:]
+    return False
+
+
+class Unseekable(object):
+    """a write only stream, like a socket or an HTTP response"""
+
+    def __init__(self):
+        self.data = BytesIO()
+
+    def write(self, data):
+        return self.data.write(data)
+
+    def flush(self):
+        pass
+
+
+@unittest.skipUnless(ZIP_STREAMING, "zipfile internals differ")
+class TestArchive(unittest.TestCase):
+
+    def copy_archive(self, outfile):
+        source = zipfile.ZipFile(template_path('py3o_image_injection.odt'))
+        out = zipfile.ZipFile(outfile, 'w')
+        for info in source.infolist():
+            copy_member(source, out, info)
+        out.writestr('added.txt', b'added after the copied members')
+        out.close()
+        return source
+
+    def check_copy(self, source, data):
+        copied = zipfile.ZipFile(BytesIO(data))
+        self.assertIsNone(copied.testzip())
+        self.assertEqual(
+            copied.namelist(), source.namelist() + ['added.txt']
+        )
+        for info in source.infolist():
+            copy_info = copied.getinfo(info.filename)
+            self.assertEqual(copy_info.compress_type, info.compress_type)
+            self.assertEqual(copy_info.CRC, info.CRC)
+            self.assertEqual(
+                read_raw_member(copied, copy_info),
+                read_raw_member(source, info),
+            )
+            self.assertEqual(
+                copied.read(info.filename), source.read(info.filename)
+            )
+
+    def test_copy_member(self):
+        outfile = BytesIO()
+        source = self.copy_archive(outfile)
+        self.check_copy(source, outfile.getvalue())
+
+    def test_copy_member_unseekable(self):
+        outfile = Unseekable()
+        source = self.copy_archive(outfile)
+        self.check_copy(source, outfile.data.getvalue())
+
+    @unittest.skipIf(ThreadPoolExecutor is None, "no thread pools")
+    def test_write_deflated_blocks(self):
+        data = b''.join(
+            b'<row><cell>%d</cell><cell>%d</cell></row>' % (i, i * i)
+            for i in range(20000)
+        )
+        blocks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+        executor = ThreadPoolExecutor(3)
+
+        for outfile in (BytesIO(), Unseekable()):
+            out = zipfile.ZipFile(outfile, 'w')
+            out.writestr('before.txt', b'before')
+            sizes = list(write_deflated_blocks(
+                out, zipfile.ZipInfo('content.xml'), iter(blocks), executor,
+                6, block_size=16384
+            ))
+            list(write_deflated_blocks(
+                out, zipfile.ZipInfo('empty.xml'), [], executor, 6
+            ))
+            out.writestr('after.txt', b'after')
+            out.close()
+
+            self.assertEqual(sum(sizes), len(data))
+            self.assertTrue(len(sizes) > 1)
+            if isinstance(outfile, Unseekable):
+                outfile = outfile.data
+            result = zipfile.ZipFile(BytesIO(outfile.getvalue()))
+            self.assertIsNone(result.testzip())
+            self.assertEqual(result.read('content.xml'), data)
+            self.assertEqual(result.read('empty.xml'), b'')
+            self.assertEqual(result.read('after.txt'), b'after')
+            info = result.getinfo('content.xml')
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertTrue(info.compress_size < len(data) / 2)
+
+        executor.shutdown()
+
+    @unittest.skipIf(ThreadPoolExecutor is None, "no thread pools")
+    def test_write_deflated_blocks_zip64(self):
+        data = b''.join(b'<row>%d</row>' % i for i in range(20000))
+        executor = ThreadPoolExecutor(2)
+        for outfile in (BytesIO(), Unseekable()):
+            out = zipfile.ZipFile(outfile, 'w')
+            # a member larger than the limit of the zip headers
+            with patch('zipfile.ZIP64_LIMIT', 1000):
+                list(write_deflated_blocks(
+                    out, zipfile.ZipInfo('content.xml'), [data], executor, 6
+                ))
+                out.writestr('after.txt', b'after')
+                out.close()
+
+            if isinstance(outfile, Unseekable):
+                outfile = outfile.data
+            result = zipfile.ZipFile(BytesIO(outfile.getvalue()))
+            self.assertIsNone(result.testzip())
+            self.assertTrue(has_zip64_header(
+                outfile.getvalue(), result.getinfo('content.xml')
+            ))
+            self.assertEqual(result.read('content.xml'), data)
+            self.assertEqual(result.read('after.txt'), b'after')
+        executor.shutdown()
+
+
+class TestCompressionPolicy(unittest.TestCase):
+
+    def render(self, compression=None):
+        template = Template(
+            template_path('py3o_image_injection.odt'), None,
+            ignore_undefined_variables=True, compression=compression,
+        )
+        with open(template_path('images/new_logo.png'), 'rb') as f:
+            logo = f.read()
+        template.set_image_data('svg_image', b'<svg/>', 'image/svg+xml')
+        result = template.render({
+            'items': [], 'document': {'total': 6}, 'logo': logo
+        })
+        return zipfile.ZipFile(BytesIO(result))
+
+    def test_member_compression(self):
+        policy = CompressionPolicy()
+        self.assertTrue(policy.is_stored('mimetype'))
+        self.assertTrue(policy.is_stored('Pictures/logo.JPG'))
+        self.assertTrue(policy.is_stored('Configurations2/images/'))
+        self.assertFalse(policy.is_stored('content.xml'))
+        self.assertFalse(policy.is_stored('Fonts/font.ttf'))
+
+        info = policy.get_info('content.xml')
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        info = policy.get_image_info('123456', 'image/png')
+        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+        info = policy.get_image_info('123456', 'svg')
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+        self.assertRaises(ValueError, CompressionPolicy, passthrough='none')
+
+    def test_default_policy(self):
+        source = zipfile.ZipFile(template_path('py3o_image_injection.odt'))
+        output = self.render()
+        self.assertIsNone(output.testzip())
+        self.assertEqual(output.namelist()[0], 'mimetype')
+
+        for info in output.infolist():
+            if info.filename in ('content.xml', 'styles.xml', 'svg_image'):
+                expected = zipfile.ZIP_DEFLATED
+            elif info.filename in source.namelist():
+                expected = source.getinfo(info.filename).compress_type
+            else:
+                # the logo
+                expected = zipfile.ZIP_STORED
+            self.assertEqual(info.compress_type, expected, info.filename)
+
+    @unittest.skipUnless(ZIP_STREAMING, "written from a temporary file")
+    def test_rendered_members_zip64(self):
+        # the size of a rendered document is unknown when its header is
+        # written, it can go past the limit of the zip headers
+        output = self.render()
+        data = output.fp.getvalue()
+        self.assertIsNone(output.testzip())
+        self.assertTrue(
+            has_zip64_header(data, output.getinfo('content.xml'))
+        )
+        self.assertFalse(
+            has_zip64_header(data, output.getinfo('mimetype'))
+        )
+
+    def test_parallel_deflate(self):
+        serial = self.render(CompressionPolicy(
+            passthrough=PASSTHROUGH_RECOMPRESS
+        ))
+        parallel = self.render(CompressionPolicy(
+            passthrough=PASSTHROUGH_RECOMPRESS, workers=2
+        ))
+        self.assertIsNone(parallel.testzip())
+        self.assertEqual(parallel.namelist(), serial.namelist())
+        for info in serial.infolist():
+            self.assertEqual(
+                parallel.getinfo(info.filename).compress_type,
+                info.compress_type
+            )
+            if info.filename != 'content.xml':
+                self.assertEqual(
+                    parallel.read(info.filename), serial.read(info.filename)
+                )
+
+    def test_recompress_passthrough(self):
+        output = self.render(CompressionPolicy(
+            deflate_level=1, passthrough=PASSTHROUGH_RECOMPRESS
+        ))
+        self.assertIsNone(output.testzip())
+        for info in output.infolist():
+            if info.filename in ('mimetype', 'Thumbnails/thumbnail.png') or (
+                info.filename.endswith('/')
+            ):
+                expected = zipfile.ZIP_STORED
+            elif info.filename == 'svg_image' or '.' in info.filename:
+                expected = zipfile.ZIP_DEFLATED
+            else:
+                # the logo
+                expected = zipfile.ZIP_STORED
+            self.assertEqual(info.compress_type, expected, info.filename)
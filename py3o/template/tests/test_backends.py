@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+import unittest
+import zipfile
+from io import BytesIO
+
+import pkg_resources
+from genshi.core import QName, Stream
+from genshi.input import XML
+
+from py3o.template import CompiledTemplate
+from py3o.template.backends import (
+    DEFAULT_BACKEND, FastBackend, GenshiBackend, ListIdFilter,
+    RenderBackend, UnsupportedTemplate, get_backend,
+)
+
+
+def template_path(name):
+    return pkg_resources.resource_filename(
+        'py3o.template', 'tests/templates/%s' % name
+    )
+
+
+class Item(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class CountingBackend(GenshiBackend):
+    """a Genshi backend counting its calls"""
+
+    name = 'counting'
+
+    def __init__(self):
+        self.calls = []
+
+    def compile(self, events, namespaces, **kwargs):
+        self.calls.append(('compile', kwargs['filename']))
+        return super(CountingBackend, self).compile(
+            events, namespaces, **kwargs
+        )
+
+    def generate(self, document, data):
+        self.calls.append(('generate', None))
+        return super(CountingBackend, self).generate(document, data)
+
+    def serialize(self, output):
+        self.calls.append(('serialize', None))
+        return super(CountingBackend, self).serialize(output)
+
+
+class RefusingBackend(RenderBackend):
+
+    name = 'refusing'
+
+    def compile(self, events, namespaces, **kwargs):
+        raise UnsupportedTemplate("nothing")
+
+
+class TestBackends(unittest.TestCase):
+
+    def render(self, engine):
+        template = CompiledTemplate(
+            template_path('py3o_simple_calc.ods'), engine=engine
+        )
+        items = [Item(col1=i, col2=i * 2, col3=i * 3, col4=i * 4)
+                 for i in range(10)]
+        result = template.render({'items': items})
+        return template, zipfile.ZipFile(BytesIO(result)).read('content.xml')
+
+    def test_get_backend(self):
+        self.assertIs(get_backend('genshi'), DEFAULT_BACKEND)
+        self.assertIsInstance(get_backend('fast'), FastBackend)
+        backend = CountingBackend()
+        self.assertIs(get_backend(backend), backend)
+        self.assertRaises(ValueError, get_backend, 'unknown')
+        self.assertRaises(ValueError, get_backend, GenshiBackend)
+
+    def test_custom_backend(self):
+        expected = self.render('genshi')[1]
+        backend = CountingBackend()
+        template, content = self.render(backend)
+        self.assertEqual(content, expected)
+        self.assertEqual(backend.calls, [
+            ('compile', 'content.xml'), ('generate', None),
+            ('serialize', None),
+        ])
+
+        template.render({'items': []})
+        self.assertEqual(len(backend.calls), 5)
+
+    def test_fallback(self):
+        expected = self.render('genshi')[1]
+        template, content = self.render(RefusingBackend())
+        self.assertEqual(content, expected)
+        prepared = dict(template.template.prepared_templates)
+        self.assertIs(prepared['content.xml'].backend, DEFAULT_BACKEND)
+
+    def test_list_ids(self):
+        source = (
+            u'<a xmlns:t="urn:t" xmlns:xml="http://www.w3.org/XML/1998/'
+            u'namespace"><t:list xml:id="x" t:a="1"/><t:list/><list/></a>'
+        )
+        events = list(XML(source))
+        list_filter = ListIdFilter(QName('urn:t}list'))
+        expected = (
+            u'<a xmlns:t="urn:t"><t:list xml:id="list1" t:a="1"/>'
+            u'<t:list xml:id="list2"/><list/></a>'
+        )
+        # each render counts from the start
+        for i in range(2):
+            stream = Stream(events) | list_filter
+            self.assertEqual(stream.render(encoding=None), expected)
+
+        backend = GenshiBackend()
+        document = backend.compile(XML(source), {'text': 'urn:t'})
+        self.assertIsNotNone(document[1])
+        document = backend.compile(XML(source), {'text': 'urn:other'})
+        self.assertIsNone(document[1])
@@ -0,0 +1,285 @@
+# -*- encoding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import lxml.etree
+import pkg_resources
+import six
+
+from pyjon.utils import get_secure_filename
+
+from py3o.template import CompiledTemplate, TemplateCache, DiskTemplateCache
+from py3o.template.archive import CompressionPolicy
+from py3o.template.backends import FastBackend
+from py3o.template.cache import CACHE_META
+from py3o.template.images import ImagePool
+from py3o.template.precompile import main as precompile_main
+
+if six.PY3:
+    # noinspection PyUnresolvedReferences
+    from unittest.mock import patch
+elif six.PY2:
+    # noinspection PyUnresolvedReferences
+    from mock import patch
+
+try:
+    from pathlib import Path
+except ImportError:  # pragma: no cover
+    Path = None
+
+
+def template_path(name):
+    return pkg_resources.resource_filename(
+        'py3o.template', 'tests/templates/%s' % name
+    )
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TemplateCache()
+        first = cache.get(template_path('py3o_simple_calc.ods'))
+        second = cache.get(template_path('py3o_simple_calc.ods'))
+
+        self.assertIsInstance(first, CompiledTemplate)
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # the options change the prepared template
+        lenient = cache.get(
+            template_path('py3o_simple_calc.ods'),
+            ignore_undefined_variables=True,
+        )
+        self.assertIsNot(first, lenient)
+        self.assertEqual(len(cache), 2)
+
+    def test_same_content_other_path(self):
+        cache = TemplateCache()
+        copy_name = get_secure_filename()
+        with open(template_path('py3o_simple_calc.ods'), 'rb') as src:
+            with open(copy_name, 'wb') as dst:
+                dst.write(src.read())
+
+        try:
+            first = cache.get(template_path('py3o_simple_calc.ods'))
+            with open(copy_name, 'rb') as f:
+                self.assertIs(cache.get(f), first)
+            with open(copy_name, 'rb') as f:
+                self.assertIs(cache.get(f.read()), first)
+
+            # with stat keys the other path is another template
+            stat_cache = TemplateCache(use_stat=True)
+            self.assertIsNot(
+                stat_cache.get(template_path('py3o_simple_calc.ods')),
+                stat_cache.get(copy_name),
+            )
+
+            # path objects are paths too
+            if Path is not None:
+                self.assertIs(cache.get(Path(copy_name)), first)
+                self.assertIs(
+                    stat_cache.get(Path(copy_name)),
+                    stat_cache.get(copy_name),
+                )
+        finally:
+            os.unlink(copy_name)
+
+    def test_lru_eviction(self):
+        cache = TemplateCache(max_entries=2)
+        names = [
+            'py3o_simple_calc.ods',
+            'py3o_logo.odt',
+            'py3o_simple_calc.ods',
+            'py3o_example_template.odt',
+        ]
+        for name in names:
+            cache.get(template_path(name))
+
+        # py3o_logo.odt was the least recently used
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.get(template_path('py3o_simple_calc.ods'))
+        cache.get(template_path('py3o_logo.odt'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_byte_budget(self):
+        small = CompiledTemplate(template_path('py3o_simple_calc.ods'))
+        cache = TemplateCache(max_bytes=small.size)
+
+        cache.get(template_path('py3o_simple_calc.ods'))
+        self.assertEqual(cache.stats()['bytes'], small.size)
+
+        # too big to ever fit: returned but not kept
+        cache.get(template_path('py3o_example_template.odt'))
+        self.assertEqual(cache.stats()['bytes'], small.size)
+        self.assertEqual(len(cache), 1)
+
+        cache.max_bytes = small.size * 2 - 1
+        cache.get(template_path('py3o_simple_calc.ods'), escape_false=True)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_render_cached_template(self):
+        cache = TemplateCache()
+        for _ in range(2):
+            outname = get_secure_filename()
+            render = cache.get(template_path('py3o_logo.odt')).new_render(
+                outname
+            )
+            render.set_image_path(
+                'staticimage.logo', template_path('images/new_logo.png')
+            )
+            render.render({'logo': None})
+            self.assertIn(
+                'staticimage.logo', zipfile.ZipFile(outname).namelist()
+            )
+            os.unlink(outname)
+
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_render_options(self):
+        cache = TemplateCache()
+        name = template_path('py3o_simple_calc.ods')
+        pool = ImagePool()
+        compression = CompressionPolicy(deflate_level=1)
+        compiled = cache.get(
+            name, compression=compression, engine='fast', image_pool=pool,
+            deterministic=True,
+        )
+        self.assertIsInstance(compiled.template.backend, FastBackend)
+        self.assertIs(compiled.template.compression, compression)
+        self.assertIs(compiled.template.images.pool, pool)
+        self.assertTrue(compiled.template.deterministic)
+
+        # the templates with other options are distinct entries
+        self.assertIsNot(cache.get(name), compiled)
+        self.assertIs(cache.get(
+            name, compression=compression, engine='fast', image_pool=pool,
+            deterministic=True,
+        ), compiled)
+        self.assertEqual(len(cache), 2)
+
+
+class TestDiskTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, compiled):
+        outname = get_secure_filename()
+        render = compiled.new_render(outname)
+        render.set_image_path(
+            'staticimage.logo', template_path('images/new_logo.png')
+        )
+        render.render({'logo': None})
+        content = zipfile.ZipFile(outname).read('content.xml')
+        os.unlink(outname)
+        return lxml.etree.tostring(lxml.etree.fromstring(content))
+
+    def test_load_prepared(self):
+        name = template_path('py3o_logo.odt')
+        expected = self.render(DiskTemplateCache(self.directory).get(name))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        # a new cache on the same directory, like a new worker would do
+        cache = DiskTemplateCache(self.directory)
+        with patch('py3o.template.main.Template.prepare') as prepare:
+            compiled = cache.get(name)
+            self.assertFalse(prepare.called)
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.render(compiled), expected)
+
+        # missing static images are still detected
+        with self.assertRaises(ValueError):
+            compiled.render({}, get_secure_filename())
+
+    def test_version_mismatch(self):
+        name = template_path('py3o_simple_calc.ods')
+        DiskTemplateCache(self.directory).get(name)
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+
+        with zipfile.ZipFile(path, 'r') as archive:
+            meta = json.loads(archive.read(CACHE_META).decode('utf-8'))
+            documents = dict(
+                (n, archive.read(n)) for n in meta['documents']
+            )
+        meta['genshi'] = '0.0'
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr(CACHE_META, json.dumps(meta))
+            for name_, document in documents.items():
+                archive.writestr(name_, document)
+
+        cache = DiskTemplateCache(self.directory)
+        cache.get(name)
+        self.assertEqual(cache.misses, 1)
+        # the stale entry was replaced
+        cache.get(name)
+        self.assertEqual(cache.hits, 1)
+
+    def test_memory_cache_on_top(self):
+        name = template_path('py3o_simple_calc.ods')
+        DiskTemplateCache(self.directory).get(name)
+
+        disk_cache = DiskTemplateCache(self.directory)
+        cache = TemplateCache(disk_cache=disk_cache)
+        self.assertIs(cache.get(name), cache.get(name))
+        self.assertEqual(disk_cache.hits, 1)
+
+    def test_render_options(self):
+        name = template_path('py3o_simple_calc.ods')
+        DiskTemplateCache(self.directory).get(name)
+
+        # the stored documents do not depend on the render options
+        disk_cache = DiskTemplateCache(self.directory)
+        compiled = disk_cache.get(name, engine='fast', deterministic=True)
+        self.assertEqual(disk_cache.hits, 1)
+        self.assertIsInstance(compiled.template.backend, FastBackend)
+        self.assertTrue(compiled.template.deterministic)
+
+
+class TestPrecompile(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.output = tempfile.mkdtemp()
+        for name in ['py3o_simple_calc.ods', 'py3o_missing_open_template.odt']:
+            shutil.copy(template_path(name), self.source)
+        with open(os.path.join(self.source, 'broken.odt'), 'wb') as f:
+            f.write(b'not a zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.output)
+
+    def test_compile_directory(self):
+        # the invalid template is reported with a non zero exit code
+        self.assertEqual(
+            precompile_main([self.source, '-o', self.output, '-j', '1']), 1
+        )
+
+        with open(os.path.join(self.output, 'manifest.json')) as f:
+            manifest = json.load(f)
+        results = dict(
+            (result['template'], result) for result in manifest['templates']
+        )
+        self.assertIn('error', results['py3o_missing_open_template.odt'])
+        self.assertIn('not a zip file', results['broken.odt']['error'])
+        calc = results['py3o_simple_calc.ods']
+        self.assertEqual(calc['directives'], 3)
+        self.assertGreater(calc['prepare_time'], 0)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.output, calc['artifact']))
+        )
+
+        cache = DiskTemplateCache(self.output)
+        cache.get(os.path.join(self.source, 'py3o_simple_calc.ods'))
+        self.assertEqual(cache.hits, 1)
@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+import base64
+import re
+import unittest
+import zipfile
+from io import BytesIO
+
+import pkg_resources
+
+from genshi.core import Markup
+from genshi.input import XML
+from genshi.template import MarkupTemplate, TemplateSyntaxError
+
+from py3o.template import CompiledTemplate, Template
+from py3o.template.fast import FastTemplate, UnsupportedTemplate
+
+LIST_ID_RE = re.compile(br'xml:id="(list[0-9]+)"')
+
+SOURCE = u"""<doc xmlns:py="http://genshi.edgewall.org/"
+     xmlns:t="urn:test">
+  <t:row py:for="index, (name, value) in enumerate(rows)" t:n="${index}">
+    <t:cell py:if="value" py:content="value"/>
+    <t:cell py:if="not value">empty</t:cell>
+    <t:name class="a ${name} ${missing}">$name &amp; ${name.upper()}</t:name>
+    <span py:strip="index % 2">${index}</span>
+    <py:for each="item in value or ()"><i>${item}</i>  \t
+\n\n</py:for>
+    <t:empty py:attrs="{'t:x': name, 'y': None}"/>
+    <t:lost title="${missing}"/>
+  </t:row>
+  <markup py:content="html" />
+  <numbers py:replace="numbers"/>
+</doc>"""
+
+
+def template_path(name):
+    return pkg_resources.resource_filename(
+        'py3o.template', 'tests/templates/%s' % name
+    )
+
+
+class Item(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestFastTemplate(unittest.TestCase):
+
+    def render_both(self, source, lookup, **data):
+        data['__py3o_loop'] = lambda iterable: iterable
+        genshi = MarkupTemplate(source, lookup=lookup).generate(**data)
+        fast = FastTemplate(XML(source), lookup=lookup, flush_size=10)
+        return (
+            u''.join(genshi.serialize()),
+            u''.join(fast.generate(**data)),
+        )
+
+    def test_same_output(self):
+        data = {
+            'rows': [
+                ('a<b', [1, 2.5]), ('"c"', None), ('d', u'\xe9t\xe9'),
+            ],
+            'html': Markup('<b>bold</b>'),
+            'numbers': [1, 2, 3],
+        }
+        genshi, fast = self.render_both(SOURCE, 'lenient', **data)
+        self.assertEqual(fast, genshi)
+
+        self.assertRaises(
+            Exception, lambda: self.render_both(SOURCE, 'strict', **data)
+        )
+        del data['rows']
+        genshi, fast = self.render_both(SOURCE, 'lenient', **data)
+        self.assertEqual(fast, genshi)
+
+    def test_unsupported(self):
+        for source in (
+            u'<a xmlns:py="http://genshi.edgewall.org/">'
+            u'<b py:choose="">x</b></a>',
+            u'<a xmlns:py="http://genshi.edgewall.org/">'
+            u'<b py:with="x = 1">${x}</b></a>',
+            u'<a xmlns:py="http://genshi.edgewall.org/">'
+            u'<b py:content="global.val"/></a>',
+            u'<a><!-- comment --></a>',
+            u'<a xml:space="preserve"> </a>',
+        ):
+            self.assertRaises(
+                UnsupportedTemplate, FastTemplate, XML(source)
+            )
+
+    def test_syntax_error(self):
+        # the document is rendered by Genshi, which reports the error
+        for engine in ('genshi', 'fast'):
+            self.assertRaises(
+                TemplateSyntaxError,
+                lambda: CompiledTemplate(
+                    template_path('py3o_all_in_one_for_loop.odt'),
+                    engine=engine,
+                ).render({}),
+            )
+
+    def test_unknown_engine(self):
+        self.assertRaises(
+            ValueError, Template,
+            template_path('py3o_example_template.odt'), None, engine='x'
+        )
+
+    def render_template(self, name, data, engine, **kwargs):
+        template = CompiledTemplate(
+            template_path(name), engine=engine, **kwargs
+        )
+        render = template.new_render()
+        render.set_image_path(
+            'staticimage.logo', template_path('images/new_logo.png')
+        )
+        result = zipfile.ZipFile(BytesIO(render.render(data)))
+        return render, dict(
+            (name, result.read(name)) for name in result.namelist()
+        )
+
+    def test_templates(self):
+        with open(template_path('images/image1.png'), 'rb') as f:
+            image = f.read()
+        items = [
+            Item(val1=i, val2=u'<&> %d' % i, val3=i, val=i,
+                 image=base64.b64encode(image),
+                 Currency='EUR', Amount=i * 1.5, InvoiceRef='#%d' % i)
+            for i in range(5)
+        ]
+        for name, data in (
+            ('py3o_example_template.odt',
+             {'items': items, 'document': Item(total=99)}),
+            ('py3o_list_template.odt', {'items': items}),
+            ('py3o_image_injection.odt',
+             {'items': items, 'document': Item(total=6), 'logo': image}),
+            ('py3o_table_cell_for_loop.odt',
+             {'items': items, 'document': Item(total=6)}),
+            ('test_false_value.odt',
+             {'false_value': False, 'false_value2': 0}),
+        ):
+            for options in ({}, {'ignore_undefined_variables': True,
+                                 'escape_false': True}):
+                render, expected = self.render_template(
+                    name, data, 'genshi', **options
+                )
+                render, result = self.render_template(
+                    name, data, 'fast', **options
+                )
+                self.assertTrue(any(
+                    isinstance(prepared.document, FastTemplate)
+                    for fname, prepared in render.prepared_templates
+                    if prepared is not None
+                ))
+                self.assertEqual(sorted(result), sorted(expected))
+                for member in expected:
+                    self.assertEqual(result[member], expected[member], name)
+
+    def test_list_ids(self):
+        template = CompiledTemplate(
+            template_path('py3o_list_template.odt'), engine='fast'
+        )
+        render = template.new_render()
+        render.set_image_path(
+            'staticimage.logo', template_path('images/new_logo.png')
+        )
+        content = zipfile.ZipFile(BytesIO(render.render({
+            'items': [Item(val=i) for i in range(4)],
+        }))).read('content.xml')
+        ids = LIST_ID_RE.findall(content)
+        self.assertEqual(
+            ids, [('list%d' % i).encode('ascii') for i in range(1, 5)]
+        )
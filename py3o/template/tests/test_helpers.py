@@ -9,9 +9,24 @@ import lxml.etree
 import pkg_resources
 import six
 
+from genshi.core import END_NS, START, Stream
+from genshi.template import MarkupTemplate
+from genshi.input import XMLParser
+
 from pyjon.utils import get_secure_filename
 
 from py3o.template.main import move_siblings, detect_keep_boundary, Template
+from py3o.template.main import (
+    DirectiveIndex,
+    get_all_python_expression,
+    get_image_frames,
+    get_instructions,
+    get_soft_breaks,
+    get_user_fields,
+    iter_encoded,
+    iter_genshi_events,
+    wrap_loops,
+)
 
 from py3o.template.data_struct import (
     Py3oModule,
@@ -447,6 +462,50 @@ class TestHelpers(unittest.TestCase):
         assert usr_insts == ['for="item in items"', '/for',
                              'for="item in items', '2', '"', '/for']
 
+    def test_directive_index(self):
+        """the index finds the same nodes as the xpath helpers"""
+        for name in [
+            'py3o_example_template.odt',
+            'py3o_image_injection.odt',
+            'py3o_soft_page_break.odt',
+        ]:
+            t = Template(
+                pkg_resources.resource_filename(
+                    'py3o.template', 'tests/templates/' + name
+                ),
+                get_secure_filename()
+            )
+            tree = t.content_trees[0]
+            index = DirectiveIndex(tree, t.namespaces)
+
+            for category, helper in [
+                ('soft_breaks', get_soft_breaks),
+                ('instructions', get_instructions),
+                ('image_frames', get_image_frames),
+                ('user_fields', get_user_fields),
+            ]:
+                self.assertEqual(
+                    index.get(category), helper(tree, t.namespaces)
+                )
+
+        # nodes of removed subtrees are forgotten
+        link = index.get('instructions')[0]
+        index.discard(link.getparent())
+        self.assertNotIn(link, index.get('instructions'))
+        self.assertNotIn(link, index.get('expressions'))
+
+    def test_directive_index_after_prepare(self):
+        t = Template(
+            pkg_resources.resource_filename(
+                'py3o.template', 'tests/templates/py3o_example_template.odt'
+            ),
+            get_secure_filename()
+        )
+        self.assertEqual(len(t.get_all_user_python_expression()), 13)
+        # the links and user fields were replaced by Genshi directives
+        t.prepare()
+        self.assertEqual(t.get_all_user_python_expression(), [])
+
     def __load_and_convert_template(self, path):
         template_xml = pkg_resources.resource_filename(
             'py3o.template',
@@ -1086,3 +1145,121 @@ class TestHelpers(unittest.TestCase):
             [1, {'c': 2}],
             [4, {'c': 5}],
         ]})
+
+    def test_python_expression_prefilter(self):
+        """cells are matched like EXSLT regexp:match would"""
+        namespaces = self.reference_template.namespaces
+        texts = [
+            '${a}', 'x ${a.b} y', '${', '${}', '${a$b}', '${a{b}',
+            '$${a}', '{a}', 'no expression', '${a} ${b', '$ {a}',
+        ]
+        cells = ''.join(
+            '<table:table-cell table:formula="%s"><text:p>%s</text:p>'
+            '</table:table-cell>' % (text, text)
+            for text in texts
+        )
+        # the first text node of a paragraph can follow a child element
+        cells += (
+            '<table:table-cell><text:p><text:span>a</text:span>${foo}'
+            '</text:p></table:table-cell>'
+            '<table:table-cell><text:p>x<text:span>a</text:span>${foo}'
+            '</text:p></table:table-cell>'
+            '<table:table-cell><text:p><text:span>${foo}</text:span>'
+            '</text:p></table:table-cell>'
+        )
+        tree = lxml.etree.ElementTree(lxml.etree.fromstring(
+            '<office:document-content xmlns:office="%s" xmlns:table="%s" '
+            'xmlns:text="%s"><table:table><table:table-row>%s'
+            '</table:table-row></table:table></office:document-content>' % (
+                namespaces['office'], namespaces['table'], namespaces['text'],
+                cells,
+            )
+        ))
+
+        expected = tree.xpath(
+            "//table:table-cell/text:p[regexp:match(text(), $expr)] | "
+            "//table:table-cell[regexp:match(@table:formula, $expr)]",
+            namespaces=namespaces,
+            expr=r'\${[^\${}]*}',
+        )
+        self.assertEqual(len(expected), 11)
+        self.assertEqual(
+            get_all_python_expression([tree], namespaces), expected
+        )
+        self.assertEqual(
+            DirectiveIndex(tree, namespaces).get('expressions'), expected
+        )
+
+    def test_genshi_events(self):
+        """lxml trees give the events Genshi would parse from their
+        serialization
+        """
+        def events(stream):
+            # positions and namespace closing order are not significant
+            return [
+                (kind, data) for kind, data, pos in stream if kind != END_NS
+            ]
+
+        xml = (
+            '<root xmlns:a="urn:a" xmlns:py="http://genshi.edgewall.org/">'
+            'text<a:child a:attr="1" other="&lt;2&gt;">child text'
+            '<!-- comment --><?target data?>'
+            '<leaf xmlns:b="urn:b" b:x="y"/>leaf tail</a:child>'
+            '<span py:for="i in items">${i}</span>tail</root>'
+        )
+        self.assertEqual(
+            events(iter_genshi_events(lxml.etree.fromstring(xml))),
+            events(XMLParser(six.BytesIO(xml.encode('utf-8')))),
+        )
+
+        self.reference_template.prepare()
+        for tree in self.reference_template.content_trees:
+            self.assertEqual(
+                events(iter_genshi_events(tree.getroot())),
+                events(XMLParser(six.BytesIO(
+                    lxml.etree.tostring(tree.getroot())
+                ))),
+            )
+
+    def test_iter_encoded(self):
+        chunks = [u'<a>', u'\xe9t\xe9', u'</a>', u'<b/>', u'x']
+        blocks = list(iter_encoded(chunks, 7))
+        self.assertEqual(
+            blocks, [u'<a>\xe9t\xe9</a>'.encode('utf-8'), b'<b/>x']
+        )
+        self.assertEqual(
+            list(iter_encoded(chunks, 1)),
+            [chunk.encode('utf-8') for chunk in chunks],
+        )
+        self.assertEqual(list(iter_encoded([], 10)), [])
+
+    def test_wrap_loops(self):
+        xml = (
+            '<root xmlns:py="http://genshi.edgewall.org/">'
+            '<py:for each="i in range(3)">${i}</py:for>'
+            '<span py:for="a, b in  pairs">${a}${b}</span>'
+            '</root>'
+        )
+        stream = Stream(list(wrap_loops(
+            XMLParser(six.BytesIO(xml.encode('utf-8'))), 'loop'
+        )))
+        loops = [
+            data[1].get('each') or data[1].get(
+                '{http://genshi.edgewall.org/}for'
+            )
+            for kind, data, pos in stream
+            if kind is START and len(data[1])
+        ]
+        self.assertEqual(loops, ['i in loop(range(3))', 'a, b in loop(pairs)'])
+
+        seen = []
+
+        def loop(iterable):
+            seen.append(iterable)
+            return iterable
+
+        result = MarkupTemplate(stream).generate(
+            loop=loop, pairs=[(1, 2)]
+        ).render()
+        self.assertEqual(result, '<root>012<span>12</span></root>')
+        self.assertEqual(seen, [range(3), [(1, 2)]])
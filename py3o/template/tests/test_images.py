@@ -0,0 +1,388 @@
+# -*- encoding: utf-8 -*-
+import array
+import base64
+import binascii
+import gc
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from io import BytesIO
+
+import pkg_resources
+import six
+
+from py3o.template import (
+    CompiledTemplate, CompressionPolicy, ImagePool, Template,
+)
+from py3o.template.main import ImageInjector
+from py3o.template.images import (
+    ImageStore, as_buffer, get_path_identifier, iter_b64decode,
+)
+
+try:
+    from pathlib import Path
+except ImportError:  # pragma: no cover
+    Path = None
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+def template_path(name):
+    return pkg_resources.resource_filename(
+        'py3o.template', 'tests/templates/%s' % name
+    )
+
+
+def read_images():
+    images = []
+    for i in (1, 2, 3):
+        with open(template_path('images/image%d.png' % i), 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+class TestImageStore(unittest.TestCase):
+
+    def test_spill(self):
+        store = ImageStore(spill_size=10)
+        store.add('small', b'0123456789', 'image/png')
+        store.add('large', b'01234567890', 'image/png')
+
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store['small'].in_memory)
+        self.assertTrue(store['large'].temporary)
+        self.assertEqual(store['small'].read(), b'0123456789')
+        self.assertEqual(store['large'].read(), b'01234567890')
+        with store['large'].open() as f:
+            self.assertEqual(f.read(), b'01234567890')
+        self.assertEqual(store['large'].size, 11)
+
+        # replacing an image removes its spilled file
+        path = store['large'].path
+        store.add('large', b'small', 'image/png')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(store['large'].in_memory)
+
+        store.add('other', b'another large image')
+        spill_dir = store.spill_dir
+        self.assertTrue(os.path.isdir(spill_dir))
+        store.close()
+        self.assertFalse(os.path.exists(spill_dir))
+        self.assertEqual(len(store), 0)
+
+    def test_no_spill(self):
+        store = ImageStore(spill_size=None)
+        store.add('image', b'x' * 1000)
+        self.assertTrue(store['image'].in_memory)
+        self.assertIsNone(store.spill_dir)
+
+    def test_iter_b64decode(self):
+        data = os.urandom(1000)
+        for encoded in (
+            base64.b64encode(data),
+            base64.b64encode(data).decode('ascii'),
+            memoryview(base64.encodestring(data) if six.PY2
+                       else base64.encodebytes(data)),
+        ):
+            for chunk_size in (1, 7, 64, 4096):
+                self.assertEqual(
+                    b''.join(iter_b64decode(encoded, chunk_size)), data
+                )
+        self.assertRaises(
+            binascii.Error, lambda: b''.join(iter_b64decode(b'QUJDR'))
+        )
+
+    def test_streamed_base64(self):
+        store = ImageStore(spill_size=100)
+        data = os.urandom(1000)
+        identifier = hashlib.sha256(data).hexdigest()
+
+        encoded = base64.b64encode(data).decode('ascii')
+        self.assertEqual(store.add_content(encoded, 'png', True), identifier)
+        self.assertTrue(store[identifier].temporary)
+        self.assertEqual(store[identifier].size, 1000)
+        self.assertEqual(store[identifier].read(), data)
+
+        # adding it again leaves no file behind
+        store.add_content(base64.b64encode(data), 'png', True)
+        self.assertEqual(len(os.listdir(store.spill_dir)), 1)
+        store.close()
+
+    @unittest.skipIf(tracemalloc is None, "no tracemalloc")
+    def test_streamed_base64_memory(self):
+        store = ImageStore(spill_size=1024)
+        encoded = base64.b64encode(os.urandom(4 * 1024 * 1024))
+        tracemalloc.start()
+        try:
+            store.add_content(encoded, 'png', True)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            store.close()
+        self.assertTrue(peak < 1024 * 1024, peak)
+
+    @unittest.skipIf(six.PY2, "no buffer casts")
+    def test_buffers(self):
+        data = array.array('i', range(100))
+        buffer = as_buffer(data)
+        self.assertEqual(len(buffer), len(data) * data.itemsize)
+
+        store = ImageStore(spill_size=None)
+        identifier = store.add_content(data)
+        self.assertEqual(
+            identifier, hashlib.sha256(data.tobytes()).hexdigest()
+        )
+        # the image is a view on the array, not a copy
+        self.assertIs(store[identifier].data.obj, data)
+
+    def render(self, compiled, images):
+        render = compiled.new_render()
+        render.set_image_data('staticimage.logo', images[0], 'image/png')
+        result = render.render({
+            'items': [
+                {'val1': i, 'val3': i, 'image': base64.b64encode(image)}
+                for i, image in enumerate(images)
+            ],
+            'document': {'total': 6},
+            'logo': images[1],
+        })
+        return zipfile.ZipFile(BytesIO(result))
+
+    def test_render_spilled_images(self):
+        images = read_images()
+        in_memory = self.render(CompiledTemplate(
+            template_path('py3o_image_injection.odt'),
+            image_spill_size=None,
+        ), images)
+
+        for workers in (None, 2):
+            spilled = self.render(CompiledTemplate(
+                template_path('py3o_image_injection.odt'),
+                image_spill_size=0,
+                compression=CompressionPolicy(workers=workers),
+            ), images)
+            self.assertIsNone(spilled.testzip())
+            self.assertEqual(spilled.namelist(), in_memory.namelist())
+            for name in in_memory.namelist():
+                self.assertEqual(spilled.read(name), in_memory.read(name))
+
+    def test_spilled_images_removed(self):
+        images = read_images()
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+        compiled = CompiledTemplate(
+            template_path('py3o_image_injection.odt'),
+            image_spill_size=10, image_spill_dir=spill_dir,
+        )
+        data = {
+            'items': [
+                {'val1': 0, 'val3': 0, 'image': base64.b64encode(images[0])}
+            ],
+            'document': {'total': 6},
+            'logo': images[1],
+        }
+        # the rendered templates are only collected by the cyclic garbage
+        # collector
+        gc.disable()
+        try:
+            for i in range(3):
+                compiled.render(data)
+                self.assertEqual(os.listdir(spill_dir), [])
+
+            render = compiled.new_render(BytesIO())
+            for status in render.render_flow(data):
+                pass
+            self.assertEqual(os.listdir(spill_dir), [])
+        finally:
+            gc.enable()
+
+    def test_lazy_sources(self):
+        images = read_images()
+        compiled = CompiledTemplate(template_path('py3o_image_injection.odt'))
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return BytesIO(images[2])
+
+        path = template_path('images/image1.png')
+        # the template gives isb64=True to py3o.image
+        items = [
+            {'val1': 0, 'val3': 0, 'image': loader},
+            {'val1': 1, 'val3': 1, 'image': lambda: images[1]},
+            {'val1': 2, 'val3': 2,
+             'image': memoryview(base64.b64encode(images[0]))},
+        ]
+        if Path is not None:
+            items.append({'val1': 3, 'val3': 3, 'image': Path(path)})
+
+        outfile = BytesIO()
+        render = compiled.new_render(outfile)
+        render.set_image_path(
+            'staticimage.logo', template_path('images/new_logo.png')
+        )
+        data = {'items': items, 'document': {'total': 6}, 'logo': None}
+        for status in render.render_flow(data, progress=True):
+            if status.phase == 'generate':
+                # loaders are called when the archive is written
+                self.assertEqual(calls, [])
+        self.assertEqual(calls, [1])
+
+        result = zipfile.ZipFile(outfile)
+        self.assertIsNone(result.testzip())
+        self.assertEqual(result.read('py3o-image-1'), images[2])
+        self.assertEqual(result.read('py3o-image-2'), images[1])
+        self.assertIn(
+            hashlib.sha256(images[0]).hexdigest(), result.namelist()
+        )
+        if Path is not None:
+            self.assertEqual(
+                result.read(get_path_identifier(path)), images[0]
+            )
+        with open(template_path('images/new_logo.png'), 'rb') as f:
+            self.assertEqual(result.read('staticimage.logo'), f.read())
+
+    def test_injector_sources(self):
+        template = Template(template_path('py3o_image_injection.odt'), None)
+        injector = ImageInjector(template)
+        path = template_path('images/image1.png')
+        images = read_images()
+
+        attrs = injector(path, 'png')
+        identifier = get_path_identifier(path)
+        self.assertIn(identifier, attrs.values())
+        self.assertEqual(template.images[identifier].path, path)
+        self.assertEqual(template.images[identifier].read(), images[0])
+        # the same path is the same image
+        injector(path, 'png')
+        self.assertEqual(len(template.images), 1)
+
+        # with isb64 text is base64
+        encoded = base64.b64encode(images[1]).decode('ascii')
+        injector(encoded, 'png', isb64=True)
+        self.assertIn(hashlib.sha256(images[1]).hexdigest(), template.images)
+
+        # bytes-like objects are not copied
+        data = bytearray(images[2])
+        injector(data, 'png')
+        self.assertIs(
+            template.images[hashlib.sha256(data).hexdigest()].data, data
+        )
+
+    def test_deterministic_files(self):
+        images = read_images()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = [os.path.join(directory, name) for name in ('a.png', 'b.png')]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(images[0])
+        digest = hashlib.sha256(images[0]).hexdigest()
+
+        for pool in (None, ImagePool()):
+            store = ImageStore(pool=pool, deterministic=True).new()
+            # the same content at another path or modified at another time
+            # is the same image
+            self.assertEqual(store.add_file(paths[0]), digest)
+            os.utime(paths[1], (1e9, 1e9))
+            self.assertEqual(store.add_file(paths[1]), digest)
+            self.assertEqual(store.add_content(images[0]), digest)
+            self.assertEqual(len(store), 1)
+
+            store = ImageStore(pool=pool)
+            self.assertNotEqual(store.add_file(paths[0]), digest)
+
+
+class TestImagePool(unittest.TestCase):
+
+    def test_identity(self):
+        images = read_images()
+        pool = ImagePool()
+        encoded = base64.b64encode(images[0])
+        digest = hashlib.sha256(images[0]).hexdigest()
+
+        identifier, data, mime_type, shared = pool.get(encoded, True, 'png')
+        self.assertEqual(identifier, digest)
+        self.assertEqual(data, images[0])
+        self.assertTrue(shared)
+        self.assertEqual(pool.stats()['misses'], 1)
+
+        # the same object is neither decoded nor hashed again
+        again = pool.get(encoded, True)
+        self.assertIs(again[1], data)
+        self.assertEqual(again[2], 'png')
+        self.assertEqual(pool.stats()['hits'], 1)
+
+        # equal content is hashed but shares the first copy
+        copied = pool.get(bytes(bytearray(images[0])))
+        self.assertIs(copied[1], data)
+        self.assertEqual(pool.stats()['misses'], 2)
+
+        # mutable buffers are not kept
+        buffer = bytearray(images[1])
+        identifier, data, mime_type, shared = pool.get(buffer)
+        self.assertIs(data, buffer)
+        self.assertFalse(shared)
+        self.assertEqual(len(pool), 1)
+
+        path = template_path('images/image1.png')
+        self.assertEqual(pool.get_path(path), get_path_identifier(path))
+        pool.get_path(path)
+        self.assertEqual(pool.stats()['hits'], 2)
+
+    def test_eviction(self):
+        images = [b'a' * 100, b'b' * 100, b'c' * 100]
+        pool = ImagePool(max_bytes=200)
+        for image in images:
+            pool.get(image)
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertTrue(pool.total_bytes <= pool.max_bytes)
+        # the source of the evicted image is forgotten with it
+        pool.get(images[0])
+        self.assertEqual(pool.stats()['hits'], 0)
+
+        pool = ImagePool(max_bytes=10)
+        identifier, data, mime_type, shared = pool.get(images[0])
+        self.assertFalse(shared)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.total_bytes, 0)
+
+    def test_shared_renders(self):
+        images = read_images()
+        pool = ImagePool()
+        compiled = CompiledTemplate(
+            template_path('py3o_image_injection.odt'),
+            image_spill_size=0, image_pool=pool,
+        )
+        items = [
+            {'val1': i, 'val3': i, 'image': base64.b64encode(image)}
+            for i, image in enumerate(images)
+        ]
+        data = {'items': items, 'document': {'total': 6}, 'logo': None}
+
+        stored = []
+        for i in range(2):
+            render = compiled.new_render(BytesIO())
+            render.set_image_data('staticimage.logo', images[0], 'image/png')
+            render.render(data)
+            stored.append(render.images)
+        self.assertEqual(pool.stats()['misses'], 3)
+        self.assertEqual(pool.stats()['hits'], 3)
+        for identifier, image in stored[0].items():
+            if identifier == 'staticimage.logo':
+                continue
+            # pooled images are shared instead of spilled
+            self.assertTrue(image.in_memory)
+            self.assertIs(stored[1][identifier].data, image.data)
+
+        result = zipfile.ZipFile(BytesIO(compiled.render(data)))
+        for image in images:
+            self.assertEqual(
+                result.read(hashlib.sha256(image).hexdigest()), image
+            )
@@ -0,0 +1,54 @@
+# -*- encoding: utf-8 -*-
+import unittest
+
+from genshi.core import QName, Stream
+from genshi.input import XML
+from genshi.template import MarkupTemplate
+from genshi.template.base import EXPR
+
+from py3o.template.segments import StaticMarkup, iter_static_segments
+
+SOURCE = u"""<doc xmlns:py="http://genshi.edgewall.org/"
+     xmlns:t="urn:test">
+  <t:style t:name="a &amp; b">
+    <t:para>static   \t
+\n\n text &lt; $$5</t:para>
+    <t:empty/>
+  </t:style>
+  <t:row py:for="name in names">
+    <t:cell t:n="1">fixed</t:cell>
+    <t:cell>${name}</t:cell>
+  </t:row>
+  <t:pre xml:space="preserve"><t:s>  </t:s></t:pre>
+  <t:list><t:item>x</t:item></t:list>
+  <u:other xmlns:u="urn:other"><u:x/></u:other>
+  <t:title title="${title}"/>
+</doc>"""
+
+
+class TestStaticSegments(unittest.TestCase):
+
+    def render(self, events, **data):
+        template = MarkupTemplate(Stream(events), lookup='lenient')
+        return u''.join(template.generate(**data).serialize())
+
+    def test_same_output(self):
+        list_tag = QName('urn:test}list')
+        events = list(XML(SOURCE))
+        segments = list(iter_static_segments(events, list_tag))
+        static = [
+            data.markup for kind, data, pos in segments
+            if kind is EXPR and isinstance(data, StaticMarkup)
+        ]
+        self.assertEqual(static, [
+            u'<t:style t:name="a &amp; b">\n'
+            u'    <t:para>static\n text &lt; $5</t:para>\n'
+            u'    <t:empty/>\n  </t:style>',
+            u'<t:cell t:n="1">fixed</t:cell>',
+            u'<t:item>x</t:item>',
+            u'<u:x/>',
+        ])
+        for data in ({'names': [u'a<b', u'c'], 'title': u'"t"'}, {}):
+            self.assertEqual(
+                self.render(segments, **data), self.render(events, **data)
+            )
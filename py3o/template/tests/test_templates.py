@@ -1,6 +1,8 @@
 # -*- encoding: utf-8 -*-
 import datetime
 import os
+import shutil
+import tempfile
 import unittest
 import zipfile
 import traceback
@@ -16,15 +18,22 @@ from io import BytesIO
 from genshi.template import TemplateError
 from pyjon.utils import get_secure_filename
 
-from py3o.template import Template, TextTemplate, TemplateException
-from py3o.template.main import XML_NS, get_soft_breaks
+from py3o.template import (
+    Template, TextTemplate, TemplateException, CompiledTemplate
+)
+from py3o.template.main import XML_NS, ZIP_STREAMING, get_soft_breaks
 
 if six.PY3:
     # noinspection PyUnresolvedReferences
-    from unittest.mock import Mock
+    from unittest.mock import Mock, patch
 elif six.PY2:
     # noinspection PyUnresolvedReferences
-    from mock import Mock
+    from mock import Mock, patch
+
+try:
+    from pathlib import Path
+except ImportError:  # pragma: no cover
+    Path = None
 
 
 class TestTemplate(unittest.TestCase):
@@ -1001,3 +1010,332 @@ class TestTemplate(unittest.TestCase):
         expected = expected.replace("\n", "").replace(" ", "")
 
         self.assertEqual(result, expected)
+
+    def test_compiled_template_renders_many_times(self):
+        """A compiled template can be rendered repeatedly with other data"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_image_injection.odt'
+        )
+        image_names = [
+            pkg_resources.resource_filename(
+                'py3o.template',
+                'tests/templates/images/image{i}.png'.format(i=i)
+            ) for i in range(1, 4)
+        ]
+        images = [open(iname, 'rb').read() for iname in image_names]
+
+        compiled = CompiledTemplate(template_name)
+        source = zipfile.ZipFile(template_name, 'r')
+        source_entries = len(lxml.etree.fromstring(
+            source.read('META-INF/manifest.xml')
+        ))
+
+        for image in images:
+            outname = get_secure_filename()
+            compiled.render(
+                {
+                    'items': [
+                        Mock(val1=1, val3=1, image=base64.b64encode(image))
+                    ],
+                    'document': Mock(total=6),
+                    'logo': image,
+                },
+                outname,
+            )
+
+            outodt = zipfile.ZipFile(outname, 'r')
+            manifest = lxml.etree.fromstring(
+                outodt.read('META-INF/manifest.xml')
+            )
+            # the same image is used twice, it is only stored once
+            self.assertEqual(len(manifest), source_entries + 1)
+            self.assertIn(image, [
+                outodt.read(name) for name in outodt.namelist()
+            ])
+            outodt.close()
+            os.unlink(outname)
+
+    def test_compiled_template_static_image_check(self):
+        """Missing static images are reported at render time"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_logo.odt'
+        )
+        compiled = CompiledTemplate(template_name)
+        outname = get_secure_filename()
+
+        render = compiled.new_render(outname)
+        with self.assertRaises(TemplateException):
+            render.render({})
+
+        render = compiled.new_render(outname)
+        render.set_image_path(
+            'staticimage.logo',
+            pkg_resources.resource_filename(
+                'py3o.template',
+                'tests/templates/images/new_logo.png'
+            )
+        )
+        render.render({})
+        self.assertIn('staticimage.logo', zipfile.ZipFile(outname).namelist())
+        os.unlink(outname)
+
+    def test_files_without_directives_are_copied(self):
+        """Templated files without any directive do not go through Genshi"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_simple_calc.ods'
+        )
+        outname = get_secure_filename()
+        template = Template(template_name, outname)
+        template.render({'items': [Mock(col1=1, col2=2, col3=3, col4=4)]})
+
+        prepared = dict(template.prepared_templates)
+        self.assertIsNotNone(prepared['content.xml'])
+        self.assertIsNone(prepared['styles.xml'])
+
+        source = zipfile.ZipFile(template_name, 'r')
+        outods = zipfile.ZipFile(outname, 'r')
+        self.assertEqual(
+            outods.read('styles.xml'), source.read('styles.xml')
+        )
+        self.assertNotEqual(
+            outods.read('content.xml'), source.read('content.xml')
+        )
+        os.unlink(outname)
+
+    @unittest.skipUnless(ZIP_STREAMING, "zipfile cannot stream members")
+    def test_output_without_temp_files(self):
+        """Rendered documents are streamed straight into the archive"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_simple_calc.ods'
+        )
+        outname = get_secure_filename()
+        template = Template(template_name, outname)
+        with patch('py3o.template.main.get_secure_filename') as tempname:
+            template.render({'items': [Mock(col1=1, col2=2, col3=3, col4=4)]})
+        self.assertFalse(tempname.called)
+
+        outods = zipfile.ZipFile(outname, 'r')
+        self.assertIsNone(outods.testzip())
+        self.assertIn(b'<table:table-cell', outods.read('content.xml'))
+        os.unlink(outname)
+
+    def test_in_memory_rendering(self):
+        """Templates can be read from and rendered to memory"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_simple_calc.ods'
+        )
+        with open(template_name, 'rb') as f:
+            template_data = f.read()
+        data = {'items': [Mock(col1=1, col2=2, col3=3, col4=4)]}
+
+        outname = get_secure_filename()
+        Template(template_name, outname).render(data)
+        with open(outname, 'rb') as f:
+            expected = zipfile.ZipFile(BytesIO(f.read()), 'r')
+        os.unlink(outname)
+
+        results = [
+            Template(template_data, None).render(data),
+            Template(memoryview(template_data), None).render(data),
+            CompiledTemplate(BytesIO(template_data)).render(data),
+        ]
+        outfile = BytesIO()
+        self.assertIsNone(
+            Template(BytesIO(template_data), outfile).render(data)
+        )
+        results.append(outfile.getvalue())
+
+        for result in results:
+            self.assertIsInstance(result, bytes)
+            outods = zipfile.ZipFile(BytesIO(result), 'r')
+            self.assertEqual(outods.namelist(), expected.namelist())
+            self.assertEqual(
+                outods.read('content.xml'), expected.read('content.xml')
+            )
+
+        template = Template(template_data, None)
+        self.assertRaises(
+            TemplateException, list, template.render_flow(data)
+        )
+
+    def test_text_template_in_memory(self):
+        """Text templates can be read from and rendered to memory"""
+        template = TextTemplate(BytesIO(b'${a} \xc3\xa9'), None)
+        self.assertEqual(template.render({'a': 1}), u'1 \xe9'.encode('utf-8'))
+
+        outfile = BytesIO()
+        template = TextTemplate(
+            BytesIO(b'${a} \xc3\xa9'), outfile, encoding='latin-1'
+        )
+        self.assertIsNone(template.render({'a': 1}))
+        self.assertEqual(outfile.getvalue(), b'1 \xe9')
+
+    @unittest.skipIf(Path is None, "no pathlib")
+    def test_text_template_paths(self):
+        """Text templates can be given path objects"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source = Path(directory) / 'template.txt'
+        with open(str(source), 'wb') as f:
+            f.write(b'${a} \xc3\xa9')
+        output = Path(directory) / 'output.txt'
+        TextTemplate(source, output).render({'a': 1})
+        with open(str(output), 'rb') as f:
+            self.assertEqual(f.read(), u'1 \xe9'.encode('utf-8'))
+
+    def test_render_flow_flush_size(self):
+        """render_flow yields once per block written"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_simple_calc.ods'
+        )
+        data = {'items': [Mock(col1=i, col2=2, col3=3, col4=4)
+                          for i in range(100)]}
+
+        outputs = []
+        steps = []
+        for flush_size in (1, 1024, 1024 * 1024):
+            outfile = BytesIO()
+            template = Template(template_name, outfile, flush_size=flush_size)
+            steps.append(len([
+                status
+                for status in template.render_flow(data, progress=True)
+                if status.phase == 'serialize'
+            ]))
+            outputs.append(
+                zipfile.ZipFile(outfile, 'r').read('content.xml')
+            )
+
+        self.assertTrue(steps[0] > steps[1] > steps[2])
+        # content.xml in one block
+        self.assertEqual(steps[2], 1)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def test_render_flow_progress(self):
+        """render_flow reports its progress when asked to"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_simple_calc.ods'
+        )
+        data = {'items': [Mock(col1=i, col2=2, col3=3, col4=4)
+                          for i in range(100)]}
+
+        outfile = BytesIO()
+        template = Template(template_name, outfile, flush_size=1024)
+        self.assertTrue(all(
+            status is True for status in template.render_flow(data)
+        ))
+
+        outfile = BytesIO()
+        template = Template(template_name, outfile, flush_size=1024)
+        records = list(template.render_flow(data, progress=True))
+
+        self.assertEqual(records[0].phase, 'prepare')
+        self.assertEqual(records[-1].phase, 'zip')
+        self.assertIsNone(records[-1].member)
+        phases = set((r.phase, r.member) for r in records)
+        self.assertIn(('generate', 'content.xml'), phases)
+        self.assertIn(('serialize', 'content.xml'), phases)
+        self.assertIn(('zip', 'mimetype'), phases)
+        # styles.xml has no directive, it is copied
+        self.assertIn(('zip', 'styles.xml'), phases)
+
+        outods = zipfile.ZipFile(outfile, 'r')
+        self.assertEqual(
+            records[-1].bytes_written,
+            sum(info.file_size for info in outods.infolist()),
+        )
+        for previous, record in zip(records, records[1:]):
+            self.assertTrue(previous.bytes_written <= record.bytes_written)
+            self.assertTrue(previous.elapsed <= record.elapsed)
+            self.assertTrue(previous.iterations <= record.iterations)
+        self.assertEqual(records[0].iterations, 0)
+        self.assertEqual(records[-1].iterations, 100)
+
+    def test_manifest_is_not_rendered(self):
+        """The manifest is only rewritten when images were added"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_image_injection.odt'
+        )
+        compiled = CompiledTemplate(template_name)
+        self.assertIsNone(
+            dict(compiled.template.prepared_templates)['META-INF/manifest.xml']
+        )
+
+        source = zipfile.ZipFile(template_name, 'r')
+        outname = get_secure_filename()
+        compiled.render(
+            {'items': [], 'document': Mock(total=6), 'logo': None}, outname
+        )
+        outodt = zipfile.ZipFile(outname, 'r')
+        self.assertEqual(
+            outodt.read('META-INF/manifest.xml'),
+            source.read('META-INF/manifest.xml'),
+        )
+        os.unlink(outname)
+
+    def test_deterministic_render(self):
+        """Deterministic renders of the same data give the same bytes"""
+        template_name = pkg_resources.resource_filename(
+            'py3o.template',
+            'tests/templates/py3o_image_injection.odt'
+        )
+        images = []
+        for i in (1, 2, 3):
+            with open(pkg_resources.resource_filename(
+                'py3o.template', 'tests/templates/images/image%d.png' % i
+            ), 'rb') as f:
+                images.append(f.read())
+        data = {
+            'items': [
+                Mock(val1=i, val3=i, image=base64.b64encode(image))
+                for i, image in enumerate(images)
+            ],
+            'document': Mock(total=6),
+            'logo': images[0],
+        }
+
+        def render(compiled, static_images, now):
+            render = compiled.new_render()
+            for identifier, image in static_images:
+                render.set_image_data(identifier, image, 'image/png')
+            with patch('py3o.template.archive.time.time', return_value=now):
+                return render.render(data)
+
+        static_images = [
+            ('staticimage.logo', images[1]), ('staticimage.other', images[2]),
+        ]
+        for engine in ('genshi', 'fast'):
+            compiled = CompiledTemplate(
+                template_name, deterministic=True, engine=engine
+            )
+            first = render(compiled, static_images, 1e9)
+            second = render(compiled, static_images[::-1], 1e9 + 3600)
+            self.assertEqual(first, second)
+
+        # the images given by path are named after their content
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        logo = os.path.join(directory, 'logo.png')
+        with open(logo, 'wb') as f:
+            f.write(images[0])
+        data['logo'] = six.text_type(logo)
+        compiled = CompiledTemplate(template_name, deterministic=True)
+        first = render(compiled, static_images, 1e9)
+        os.utime(logo, (1e9, 1e9))
+        second = render(compiled, static_images, 1e9)
+        self.assertEqual(first, second)
+        data['logo'] = images[0]
+
+        # without it the images keep their order and get the current date
+        compiled = CompiledTemplate(template_name)
+        first = render(compiled, static_images, 1e9)
+        second = render(compiled, static_images[::-1], 1e9 + 3600)
+        self.assertNotEqual(first, second)
@@ -37,6 +37,8 @@ setup(
     ],
     entry_points="""
     # -*- Entry points: -*-
+    [console_scripts]
+    py3o-compile = py3o.template.precompile:main
     """,
     tests_require=['nose', 'nosexcover', 'mock'],
     test_suite='nose.collector',